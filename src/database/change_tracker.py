@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from src.database.data import DatabaseORM, fetch_rating_changes, fetch_users_feedback_data
+
+
+class RatingChangeTracker:
+    """
+    Watches the rating table for changes on a background thread, so requests never have to query the database
+    to find out whether a user's ratings are stale.
+    Keeps a high-watermark of the latest updatedAt it has seen, and every interval seconds pulls just the
+    ratings of users with rows updated since then, handing them to on_change.
+    The ratings updated at exactly the watermark are remembered too, so they're never handed over twice.
+    """
+
+    def __init__(self, db: DatabaseORM, on_change: Callable[[np.ndarray, pd.DataFrame], int], interval: float,
+                 watermark):
+        """
+        @param db: database to poll
+        @param on_change: called with (ids of the changed users, every watched rating those users now have),
+        returns how many of those users' ratings actually differ from what it already had
+        @param interval: seconds between polls
+        @param watermark: naive UTC datetime that changes are looked for from,
+        i.e. the latest updatedAt of the ratings already loaded
+        """
+        self.db = db
+        self.on_change = on_change
+        self.interval = interval
+        self.watermark = pd.Timestamp(watermark)
+        # (user id, anime id) of the ratings already handed over that were updated at exactly the watermark
+        self.seen_at_watermark = frozenset()
+
+        self.last_poll_at = None
+        self.users_changed = 0
+        self.last_error = None
+
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is None or not self.__thread.is_alive():
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__run, name="rating-change-tracker", daemon=True)
+            self.__thread.start()
+
+    def stop(self, timeout=None):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as error:  # the watermark hasn't moved, so the same changes are picked up next time
+                logging.exception("Polling for rating changes failed")
+                self.last_error = repr(error)
+
+    def poll(self):
+        """Checks for changes right now, on the calling thread"""
+        user_ids, latest_update, seen_at_latest = fetch_rating_changes(self.db, self.watermark,
+                                                                       self.seen_at_watermark)
+        if len(user_ids):
+            self.users_changed += self.on_change(user_ids, fetch_users_feedback_data(self.db, user_ids))
+        # only move the watermark on once the changes have been applied, so a failure doesn't lose any
+        self.watermark = pd.Timestamp(latest_update)
+        self.seen_at_watermark = seen_at_latest
+        self.last_poll_at = time.time()
+        self.last_error = None
+
+    def metrics(self) -> dict:
+        return {
+            "watermark": self.watermark.isoformat(),
+            "last_poll_at": self.last_poll_at,
+            "users_changed": self.users_changed,
+            "last_error": self.last_error,
+        }
@@ -1,8 +1,12 @@
+import threading
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 
 import numpy as np
 import pandas as pd
 import psycopg2
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 
 import src.database.config as config
 
@@ -32,13 +36,32 @@ def get_connection_psycopg(ini_file='./database.ini', section='postgresql'):
             return conn
 
 
+def get_connection_pool_psycopg(ini_file='./database.ini', section='postgresql', min_connections=1,
+                                max_connections=10) -> 'PsycopConnectionPool':
+    """Creates a thread safe pool of connections to the Postgres server.
+    Takes the same ini file as get_connection_psycopg.
+    """
+
+    try:
+        params = config.config(ini_file, section)
+        print('connecting to postgres')
+        return PsycopConnectionPool(ThreadedConnectionPool(min_connections, max_connections, **params))
+    except psycopg2.DatabaseError as error:
+        print(error)
+        raise psycopg2.DatabaseError('Unable to connect to database')
+
+
 class DBCursor(ABC):
 
     def __init__(self, cursor):
         self.cursor = cursor
 
     @abstractmethod
-    def execute(self, query: str, params: tuple):
+    def execute(self, query, params: tuple = ()):
+        """
+        Runs query, with any %s placeholders in it filled in from params by the database driver.
+        Values must always be passed through params, never formatted into the query.
+        """
         pass
 
     @abstractmethod
@@ -49,6 +72,14 @@ class DBCursor(ABC):
     def fetch_n(self, n):
         pass
 
+    @abstractmethod
+    def server_side(self, name: str) -> 'DBCursor':
+        """
+        Opens a new cursor on the same connection that keeps its results on the database server,
+        so rows are only transferred as they are fetched rather than all at once on execute.
+        """
+        pass
+
     @abstractmethod
     def close(self):
         pass
@@ -56,8 +87,8 @@ class DBCursor(ABC):
 
 class PsycopCursor(DBCursor):
 
-    def execute(self, query: str, params: tuple):
-        self.cursor.execute(query % params)
+    def execute(self, query, params: tuple = ()):
+        self.cursor.execute(query, params)
 
     def fetch_all(self):
         return self.cursor.fetchall()
@@ -65,10 +96,73 @@ class PsycopCursor(DBCursor):
     def fetch_n(self, n):
         return self.cursor.fetchmany(n)
 
+    def server_side(self, name: str) -> DBCursor:
+        # in psycopg2, giving a cursor a name makes it a server-side cursor
+        return PsycopCursor(self.cursor.connection.cursor(name=name))
+
     def close(self):
         self.cursor.close()
 
 
+class DBConnectionPool(ABC):
+
+    @abstractmethod
+    def connection(self):
+        """
+        Context manager that checks a connection out of the pool for the duration of the with block and yields it,
+        waiting for one to be put back if they're all in use. Changes are committed if the block succeeds and
+        rolled back if it doesn't, then the connection goes back in the pool.
+        """
+        pass
+
+    @abstractmethod
+    def cursor(self):
+        """
+        Context manager that checks a connection out of the pool for the duration of the with block,
+        yielding a DBCursor on it. Changes are committed if the block succeeds and rolled back if it doesn't,
+        then the connection goes back in the pool.
+        """
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+
+class PsycopConnectionPool(DBConnectionPool):
+
+    def __init__(self, pool: ThreadedConnectionPool):
+        self.pool = pool
+        # ThreadedConnectionPool raises PoolError rather than waiting once every connection is checked out,
+        # so checkouts wait on this instead, which only lets as many through as the pool has connections
+        self.__available = threading.BoundedSemaphore(pool.maxconn)
+
+    @contextmanager
+    def connection(self):
+        with self.__available:
+            connection = self.pool.getconn()
+            try:
+                yield connection
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                self.pool.putconn(connection)
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as connection:
+            cursor = PsycopCursor(connection.cursor())
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def close(self):
+        self.pool.closeall()
+
+
 class DatabaseORM(ABC):
     @abstractmethod
     def fetch_all(self, table_name: str):
@@ -79,49 +173,173 @@ class DatabaseORM(ABC):
         pass
 
     @abstractmethod
-    def fetch_by_condition(self, table_name: str, condition: str):
+    def fetch_by_condition(self, table_name: str, condition: str, params: tuple = ()):
+        """
+        condition is an SQL boolean expression, with %s placeholders for any values, which are given in params
+        """
+        pass
+
+    @abstractmethod
+    def count_by_condition(self, table_name: str, condition: str, params: tuple = ()) -> int:
+        pass
+
+    @abstractmethod
+    def max_by_condition(self, table_name: str, column: str, condition: str, params: tuple = ()):
+        """largest value of column among the matching rows, None if there are none"""
+        pass
+
+    @abstractmethod
+    def stream_by_condition(self, table_name: str, columns: tuple, condition: str, chunk_size: int,
+                            params: tuple = ()):
+        """
+        Generator over the matching rows, chunk_size rows at a time,
+        that never holds more than one chunk of the result in memory
+        """
         pass
 
 
 class DatabaseCustomORM(DatabaseORM):
+    # every query checks its own connection out of the pool,
+    # so requests being handled on different threads can query the database at the same time
 
-    def __init__(self, db_cursor: DBCursor):
-        self.cursor = db_cursor
+    def __init__(self, pool: DBConnectionPool):
+        self.pool = pool
 
     def fetch_all(self, table_name: str):
-        self.cursor.execute("SELECT * FROM %s;", (table_name,))
-        return self.cursor.fetch_all()
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT * FROM {};").format(sql.Identifier(table_name)))
+            return cursor.fetch_all()
 
     def fetch_n(self, table_name: str, n: int):
-        self.cursor.execute("SELECT * FROM %s LIMIT=%s;", (table_name, n))
-        return self.cursor.fetch_n(n)
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT * FROM {} LIMIT %s;").format(sql.Identifier(table_name)), (n,))
+            return cursor.fetch_n(n)
+
+    def fetch_by_condition(self, table_name: str, condition: str, params: tuple = ()):
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT * FROM {} WHERE {};").format(sql.Identifier(table_name),
+                                                                         sql.SQL(condition)), params)
+            return cursor.fetch_all()
+
+    def count_by_condition(self, table_name: str, condition: str, params: tuple = ()) -> int:
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT COUNT(*) FROM {} WHERE {};").format(sql.Identifier(table_name),
+                                                                                sql.SQL(condition)), params)
+            return cursor.fetch_all()[0][0]
+
+    def max_by_condition(self, table_name: str, column: str, condition: str, params: tuple = ()):
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT MAX({}) FROM {} WHERE {};").format(
+                sql.Identifier(column), sql.Identifier(table_name), sql.SQL(condition)), params)
+            return cursor.fetch_all()[0][0]
+
+    def stream_by_condition(self, table_name: str, columns: tuple, condition: str, chunk_size: int,
+                            params: tuple = ()):
+        with self.pool.cursor() as cursor:
+            stream_cursor = cursor.server_side(f"stream_{table_name}")
+            try:
+                stream_cursor.execute(sql.SQL("SELECT {} FROM {} WHERE {};").format(
+                    sql.SQL(", ").join(map(sql.Identifier, columns)), sql.Identifier(table_name),
+                    sql.SQL(condition)), params)
+                while chunk := stream_cursor.fetch_n(chunk_size):
+                    yield chunk
+            finally:
+                stream_cursor.close()
+
+
+FEEDBACK_COLUMNS = {'user_id': np.int32, 'anime_id': np.int32, 'rating': np.int8,
+                    'createdAt': 'datetime64[ns]', 'updatedAt': 'datetime64[ns]'}
+# nothing is recommended from when ratings were left, so these are all most of the app needs to hold in memory
+RATING_COLUMNS = ['user_id', 'anime_id', 'rating']
+# the anime table's timestamps aren't used for anything, so aren't loaded at all
+ANIME_COLUMNS = {'anime_id': np.int32, 'name': object, 'genre': 'category', 'type': 'category', 'episodes': object,
+                 'rating': np.float64, 'members': np.int32, 'synopsis': object, 'titleImage': object}
+
+
+def to_datetimes(values) -> np.ndarray:
+    """Converts a sequence of datetimes from the database into naive UTC datetime64s"""
+    return pd.to_datetime(values, utc=True).tz_convert(None).to_numpy()
+
+
+def fetch_feedback_data(db: DatabaseORM, chunk_size: int = 100_000, timestamps: bool = True) -> pd.DataFrame:
+    """
+    Loads every watched (non-zero) rating.
+    Rows are streamed from the database chunk_size at a time straight into typed numpy columns,
+    rather than fetching them all as python tuples and converting afterwards.
+
+    :param timestamps: whether to load the createdAt and updatedAt columns, or just RATING_COLUMNS
+    """
+    names = list(FEEDBACK_COLUMNS) if timestamps else RATING_COLUMNS
+    # count first so each column can be allocated once, at its final size
+    row_count = db.count_by_condition("rating", "rating <> 0")
+    columns = {name: np.empty(row_count, dtype=FEEDBACK_COLUMNS[name]) for name in names}
 
-    def fetch_by_condition(self, table_name: str, condition: str):
-        self.cursor.execute("SELECT * FROM %s WHERE %s;", (table_name, condition))
-        return self.cursor.fetch_all()
+    filled = 0
+    database_columns = ("userId", "animeId", "rating", "createdAt", "updatedAt")[:len(names)]
+    for chunk in db.stream_by_condition("rating", database_columns, "rating <> 0", chunk_size):
+        end = filled + len(chunk)
+        if end > len(columns['user_id']):  # ratings have been added since counting them, so make some more room
+            columns = {name: np.resize(column, max(end, 2 * len(column))) for name, column in columns.items()}
 
-    def __del__(self):
-        self.cursor.close()
+        for name, values in zip(names, zip(*chunk)):
+            columns[name][filled:end] = to_datetimes(values) if name in ('createdAt', 'updatedAt') else values
+        filled = end
 
+    return pd.DataFrame({name: column[:filled] for name, column in columns.items()})
 
-def fetch_feedback_data(db: DatabaseORM) -> pd.DataFrame:
-    ratings = db.fetch_all("rating")
-    ratings_df = pd.DataFrame(
-        ratings, columns=['user_id', 'anime_id', 'rating', 'createdAt', 'updatedAt'])
-    ratings_df['rating'] = ratings_df['rating'].astype(np.int8)
-    watched_ratings = ratings_df[ratings_df['rating'] != 0]
 
-    return watched_ratings
+def feedback_rows_to_df(rows) -> pd.DataFrame:
+    """Converts rows of the rating table, as fetched by SELECT *, into a feedback DataFrame with typed columns"""
+    ratings_df = pd.DataFrame(rows, columns=list(FEEDBACK_COLUMNS))
+    for column in ('createdAt', 'updatedAt'):
+        ratings_df[column] = to_datetimes(ratings_df[column].to_numpy())
+    return ratings_df.astype(FEEDBACK_COLUMNS)
 
 
 def fetch_one_feedback_data(db: DatabaseORM, user_id: int) -> pd.DataFrame:
-    ratings = db.fetch_by_condition("rating", f'"userId"={user_id}')
-    ratings_df = pd.DataFrame(
-        ratings, columns=['user_id', 'anime_id', 'rating', 'createdAt', 'updatedAt'])
-    ratings_df['rating'] = ratings_df['rating'].astype(np.int8)
-    watched_ratings = ratings_df[ratings_df['rating'] != 0]
+    ratings = db.fetch_by_condition("rating", '"userId" = %s AND rating <> 0', (user_id,))
+    return feedback_rows_to_df(ratings)
+
 
-    return watched_ratings
+def fetch_users_feedback_data(db: DatabaseORM, user_ids) -> pd.DataFrame:
+    """Every watched rating of several users, in a single query"""
+    ratings = db.fetch_by_condition("rating", '"userId" = ANY(%s) AND rating <> 0', ([int(u) for u in user_ids],))
+    return feedback_rows_to_df(ratings)
+
+
+def fetch_rating_changes(db: DatabaseORM, since, seen_at_since=frozenset()) -> tuple:
+    """
+    Finds every user with a rating added or changed at or after since.
+    The comparison is inclusive, as other ratings with exactly the latest timestamp seen may not have been
+    committed yet. The ratings already seen at that instant are passed back in as seen_at_since and skipped,
+    so only ratings that are actually new come up again.
+
+    :param since: naive UTC datetime to look for changes from, usually the latest_update returned by the last call
+    :param seen_at_since: (user id, anime id) of every rating updated at exactly since that has already been seen,
+        usually the seen_at_latest returned by the last call
+    :return: tuple of (ids of the changed users, latest_update, seen_at_latest), where latest_update is the newest
+        updatedAt seen, and seen_at_latest the (user id, anime id) of the ratings updated at it.
+        If nothing has changed, they're since and seen_at_since
+    """
+    changes = feedback_rows_to_df(db.fetch_by_condition(
+        "rating", '"updatedAt" >= %s', (pd.Timestamp(since).tz_localize('UTC').to_pydatetime(),)))
+    keys = list(zip(changes['user_id'].tolist(), changes['anime_id'].tolist()))
+    new = ~((changes['updatedAt'] == since).to_numpy() & np.array([key in seen_at_since for key in keys], dtype=bool))
+    if not new.any():
+        return np.empty(0, dtype=np.int32), since, seen_at_since
+    latest_update = changes['updatedAt'].max()
+    at_latest = (changes['updatedAt'] == latest_update).to_numpy()
+    seen_at_latest = frozenset(key for key, latest in zip(keys, at_latest) if latest)
+    return changes.loc[new, 'user_id'].unique(), latest_update, seen_at_latest
+
+
+def fetch_latest_rating_update(db: DatabaseORM):
+    """
+    When the most recently updated watched rating was updated, as a naive UTC datetime, None if there are none.
+    To use it as the change tracker's watermark for a set of loaded ratings, fetch it before loading them
+    """
+    latest_update = db.max_by_condition("rating", "updatedAt", "rating <> 0")
+    return None if latest_update is None else to_datetimes([latest_update])[0]
 
 
 def fetch_anime_data(db: DatabaseORM) -> pd.DataFrame:
@@ -131,6 +349,7 @@ def fetch_anime_data(db: DatabaseORM) -> pd.DataFrame:
         'titleImage'])
     # bad practice to have this here, but this is a school project, so can't be having an "NSFW" flag really.
     anime_df = anime_df[~anime_df["genre"].str.contains("Hentai")]
-    anime_df.dropna(inplace=True)
+    anime_df = anime_df.dropna()
 
-    return anime_df
+    # there are far fewer distinct types and genre lists than shows, so they're stored once each as categories
+    return anime_df[list(ANIME_COLUMNS)].astype(ANIME_COLUMNS).reset_index(drop=True)
@@ -0,0 +1,289 @@
+import argparse
+import contextlib
+import json
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from src.database.data import ANIME_COLUMNS, FEEDBACK_COLUMNS, RATING_COLUMNS
+from src.experimenting.sgd_benchmark import csv_feedback, synthetic_feedback
+from src.myconstants import HYBRID_CHILD_TIMEOUT_SECONDS, HYBRID_WORKERS
+from src.recommenders.collaborative_recommender import CollabRecommender
+from src.recommenders.content_recommender import ContentRecommender
+from src.recommenders.dataset import Dataset
+from src.recommenders.hybrid_recommender import HybridRecommender
+from src.recommenders.popularity_recommender import PopularityRecommender
+from src.recommenders.rating_index import RatingIndex
+
+
+# measures every recommender on the same held out ratings, for speed and for quality,
+# and writes the results as JSON so runs from different commits can be compared.
+# e.g. python -m src.experimenting.recommender_benchmark --users 2000 --items 500 --output benchmark.json
+# or, on the real data, python -m src.experimenting.recommender_benchmark --csv data/anime --users 5000
+
+SYNTHETIC_GENRES = ("Action", "Adventure", "Comedy", "Drama", "Fantasy", "Horror", "Mecha", "Mystery",
+                    "Romance", "Sci-Fi", "Slice of Life", "Sports")
+SYNTHETIC_TYPES = ("TV", "Movie", "OVA", "Special")
+
+
+def synthetic_shows(feedback: pd.DataFrame, item_count, seed=0) -> pd.DataFrame:
+    """
+    Builds an anime DataFrame of item_count shows with 1 - 3 random genres each.
+    Each show's rating and member count come from its feedback, as they would for real shows
+    """
+    rng = np.random.default_rng(seed)
+    genres = [", ".join(rng.choice(SYNTHETIC_GENRES, size=rng.integers(1, 4), replace=False))
+              for _ in range(item_count)]
+    by_show = feedback.groupby("anime_id")["rating"]
+    shows = pd.DataFrame({
+        "anime_id": np.arange(item_count),
+        "name": [f"show {anime_id}" for anime_id in range(item_count)],
+        "genre": genres,
+        "type": rng.choice(SYNTHETIC_TYPES, size=item_count),
+        "episodes": rng.integers(1, 100, size=item_count),
+        "rating": by_show.mean().reindex(range(item_count), fill_value=0.0).round(2).to_numpy(),
+        "members": by_show.size().reindex(range(item_count), fill_value=0).to_numpy(),
+        "synopsis": None,
+        "titleImage": None,
+    })
+    return shows.astype(ANIME_COLUMNS)
+
+
+def csv_shows(path) -> pd.DataFrame:
+    """Loads the anime csv, cleaned the same way database/csv_processes.py cleans it for the database"""
+    shows = pd.read_csv(path, low_memory=False)
+    shows['genre'].fillna('Unknown', inplace=True)
+    shows['type'].fillna('Unknown', inplace=True)
+    shows['rating'].fillna(0.0, inplace=True)
+    shows['members'].fillna(0, inplace=True)
+    shows['synopsis'], shows['titleImage'] = None, None
+    return shows[list(ANIME_COLUMNS)].astype(ANIME_COLUMNS).reset_index(drop=True)
+
+
+def split_holdout(ratings: pd.DataFrame, holdout_fraction, seed=0) -> tuple:
+    """
+    Randomly holds out holdout_fraction of each user's ratings, rounded down,
+    so every user keeps at least one rating to train on and users with very few ratings keep all of them.
+    Returns: tuple of (train ratings, held out ratings)
+    """
+    rng = np.random.default_rng(seed)
+    shuffled = ratings.iloc[rng.permutation(len(ratings))]
+    rank_in_user = shuffled.groupby("user_id").cumcount().to_numpy()
+    user_counts = shuffled.groupby("user_id")["user_id"].transform("size").to_numpy()
+    held_out = rank_in_user < np.floor(holdout_fraction * user_counts)
+    return shuffled[~held_out].sort_index(), shuffled[held_out].sort_index()
+
+
+def percentiles_ms(seconds) -> dict:
+    milliseconds = 1000 * np.asarray(seconds)
+    return {"p50": float(np.percentile(milliseconds, 50)), "p90": float(np.percentile(milliseconds, 90)),
+            "p99": float(np.percentile(milliseconds, 99)), "mean": float(milliseconds.mean())}
+
+
+def peak_rss_bytes() -> int:
+    """Highest resident set size this process has reached so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports it in kilobytes, mac os in bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def ranking_quality(recommended_ids: np.ndarray, user_ids, holdout: pd.DataFrame, relevant_rating) -> dict:
+    """
+    Mean precision@k and recall@k over user_ids, where k is the width of recommended_ids and
+    the relevant shows of a user are the held out ones they rated at least relevant_rating
+    """
+    relevant = holdout[holdout["rating"] >= relevant_rating].groupby("user_id")["anime_id"].apply(set)
+    k = recommended_ids.shape[1]
+    precisions, recalls = [], []
+    for user_id, recommended in zip(user_ids, recommended_ids):
+        relevant_shows = relevant.get(user_id)
+        if not relevant_shows:
+            continue
+        hits = len(relevant_shows.intersection(recommended.tolist()))
+        precisions.append(hits / k)
+        recalls.append(hits / len(relevant_shows))
+    if not precisions:
+        return {"precision_at_k": None, "recall_at_k": None}
+    return {"precision_at_k": float(np.mean(precisions)), "recall_at_k": float(np.mean(recalls))}
+
+
+def holdout_rmse(collab_r: CollabRecommender, holdout: pd.DataFrame):
+    """RMSE of the collaborative model's predicted ratings of the held out ratings it knows both the user and show of"""
+    model = collab_r.model
+    users = holdout["user_id"].map(model.user_positions)
+    items = holdout["anime_id"].map(model.item_positions)
+    known = users.notna() & items.notna()
+    if not known.any():
+        return None
+    predictions = np.einsum("ij,ij->i", model.user_factors[users[known].to_numpy(dtype=np.int64)],
+                            model.item_factors[items[known].to_numpy(dtype=np.int64)])
+    return float(np.sqrt(np.mean((holdout["rating"][known].to_numpy() - predictions) ** 2)))
+
+
+def measure_requests(recommend, user_ids) -> dict:
+    """per request latency of recommend(user_id), one user after another"""
+    timings = []
+    for user_id in user_ids:
+        start = time.perf_counter()
+        recommend(user_id)
+        timings.append(time.perf_counter() - start)
+    return percentiles_ms(timings)
+
+
+def benchmark_recommender(build, recommend, recommend_batch, latency_users, evaluation_users) -> tuple:
+    """
+    Builds a recommender and puts it through every speed measurement
+    Returns: tuple of (the recommender, its results, its top recommendations for each of evaluation_users)
+    """
+    start = time.perf_counter()
+    recommender = build()
+    results = {"train_seconds": time.perf_counter() - start}
+
+    results["latency_ms"] = measure_requests(lambda user_id: recommend(recommender, user_id), latency_users)
+
+    start = time.perf_counter()
+    recommended_ids = recommend_batch(recommender, evaluation_users)
+    elapsed = time.perf_counter() - start
+    results["batch_users_per_second"] = len(evaluation_users) / elapsed if elapsed > 0 else None
+    results["peak_rss_bytes"] = peak_rss_bytes()
+    return recommender, results, recommended_ids
+
+
+def run_benchmark(shows: pd.DataFrame, ratings: pd.DataFrame, k=10, holdout_fraction=0.2, relevant_rating=8,
+                  latency_user_count=200, evaluation_user_count=2000, seed=0, **training_options) -> dict:
+    """
+    Trains every recommender on all but a held out fraction of the ratings and measures them against it
+
+    :param shows: anime DataFrame
+    :param ratings: user_id, anime_id, rating feedback
+    :param k: number of recommendations per user, for the speed and ranking measurements
+    :param holdout_fraction: fraction of each user's ratings to hold out from training
+    :param relevant_rating: held out ratings at least this high count as relevant for precision / recall
+    :param latency_user_count: number of users to time single requests for
+    :param evaluation_user_count: number of users to recommend for in one batch and measure precision / recall on
+    :param seed: seed for the holdout split, the users picked and the collaborative model's training
+    :param training_options: passed on to calc_sgd_model through CollabRecommender
+    :return dictionary of the data used and each recommender's results, ready to be written as JSON
+    """
+    rng = np.random.default_rng(seed)
+    ratings = ratings[ratings["anime_id"].isin(shows["anime_id"])].astype(
+        {column: FEEDBACK_COLUMNS[column] for column in RATING_COLUMNS})
+    train, holdout = split_holdout(ratings[RATING_COLUMNS], holdout_fraction, seed)
+
+    dataset = Dataset(shows, train.reset_index(drop=True))
+    rating_index = RatingIndex(dataset.ratings)
+    users = rating_index.user_ids
+    latency_users = rng.choice(users, size=min(latency_user_count, len(users)), replace=False)
+    # users with something held out, so there's something to measure their recommendations against
+    held_out_users = holdout["user_id"].unique()
+    evaluation_users = rng.choice(held_out_users, size=min(evaluation_user_count, len(held_out_users)),
+                                  replace=False)
+
+    def recommend(recommender, user_id):
+        return recommender.generate_recommendations(user_id, k)
+
+    def recommend_batch(recommender, user_ids):
+        return recommender.generate_recommendations_batch(user_ids, k)[0]
+
+    report = {
+        "config": {"k": k, "holdout_fraction": holdout_fraction, "relevant_rating": relevant_rating,
+                   "seed": seed, "training_options": training_options},
+        "data": {"shows": len(shows), "users": len(users), "train_ratings": len(train),
+                 "holdout_ratings": len(holdout), "latency_users": len(latency_users),
+                 "evaluation_users": len(evaluation_users)},
+        "recommenders": {},
+    }
+    results = report["recommenders"]
+
+    content_r, results["content_recommender"], recommended = benchmark_recommender(
+        lambda: ContentRecommender(dataset, rating_index=rating_index), recommend, recommend_batch,
+        latency_users, evaluation_users)
+    results["content_recommender"].update(ranking_quality(recommended, evaluation_users, holdout, relevant_rating))
+
+    collab_r, results["collab_recommender"], recommended = benchmark_recommender(
+        lambda: CollabRecommender(dataset, rating_index=rating_index, seed=seed, **training_options), recommend,
+        recommend_batch, latency_users, evaluation_users)
+    results["collab_recommender"].update(ranking_quality(recommended, evaluation_users, holdout, relevant_rating))
+    results["collab_recommender"]["rmse"] = holdout_rmse(collab_r, holdout)
+    results["collab_recommender"]["training_curve"] = collab_r.model.training_curve
+
+    # built just as the app builds it, so its latencies include scoring the children side by side
+    with ThreadPoolExecutor(max_workers=HYBRID_WORKERS) as executor:
+        hybrid_r, results["hybrid_recommender"], recommended = benchmark_recommender(
+            lambda: HybridRecommender(dataset, [(content_r, 1.0), (collab_r, 2.0)], rating_index=rating_index,
+                                      executor=executor, child_timeout=HYBRID_CHILD_TIMEOUT_SECONDS,
+                                      max_in_flight=HYBRID_WORKERS),
+            recommend, recommend_batch, latency_users, evaluation_users)
+    results["hybrid_recommender"].update(ranking_quality(recommended, evaluation_users, holdout, relevant_rating))
+    results["hybrid_recommender"]["degraded_count"] = hybrid_r.degraded_count
+
+    # the same shows for everyone, so a "batch" is the one ranking repeated for each user
+    popularity_r, results["popularity_recommender"], recommended = benchmark_recommender(
+        lambda: PopularityRecommender(dataset.items),
+        lambda recommender, user_id: recommender.generate_recommendations(k),
+        lambda recommender, user_ids: np.tile(recommender.generate_recommendations(k)["anime_id"].to_numpy(),
+                                              (len(user_ids), 1)),
+        latency_users, evaluation_users)
+    results["popularity_recommender"].update(
+        ranking_quality(recommended, evaluation_users, holdout, relevant_rating))
+
+    for recommender_results in results.values():
+        recommender_results.setdefault("rmse", None)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="measure the speed and quality of every recommender on held out "
+                                                 "ratings, and write the results as JSON")
+    parser.add_argument("--csv", help="directory of anime.csv and rating.csv, "
+                                      "synthetic data is used if this isn't given")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=500, help="number of synthetic shows")
+    parser.add_argument("--density", type=float, default=0.05, help="fraction of synthetic user / show pairs rated")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--holdout-fraction", type=float, default=0.2)
+    parser.add_argument("--relevant-rating", type=int, default=8)
+    parser.add_argument("--latency-users", type=int, default=200)
+    parser.add_argument("--evaluation-users", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--latent-features", type=int, default=75)
+    parser.add_argument("--solver", default="minibatch")
+    parser.add_argument("--biased", action="store_true", help="train the collaborative model with bias terms")
+    parser.add_argument("--dtype", choices=("float64", "float32"), default="float64")
+    parser.add_argument("--workers", type=int, default=1, help="processes to train the collaborative model on")
+    parser.add_argument("--patience", type=int, default=3,
+                        help="epochs without validation improvement before training stops, 0 to always run --epochs")
+    parser.add_argument("--min-epochs", type=int, default=10,
+                        help="epochs to always run before training can stop, while the factors are still growing")
+    parser.add_argument("--output", help="file to write the JSON results to, standard out if this isn't given")
+    args = parser.parse_args()
+
+    if args.csv:
+        feedback = csv_feedback(f"{args.csv}/rating.csv", args.users)
+        anime = csv_shows(f"{args.csv}/anime.csv")
+    else:
+        feedback = synthetic_feedback(args.users, args.items, args.density, args.seed)
+        anime = synthetic_shows(feedback, args.items, args.seed)
+
+    # accepted_deviation of 0 so training only stops early when validation error stops improving.
+    # training prints its progress outside of PROD, which mustn't end up mixed into the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        benchmark_report = run_benchmark(anime, feedback, k=args.k, holdout_fraction=args.holdout_fraction,
+                                         relevant_rating=args.relevant_rating, latency_user_count=args.latency_users,
+                                         evaluation_user_count=args.evaluation_users, seed=args.seed,
+                                         max_epoch_count=args.epochs, latent_feature_count=args.latent_features,
+                                         solver=args.solver, accepted_deviation=0.0,
+                                         patience=args.patience or None, min_epoch_count=args.min_epochs,
+                                         biased=args.biased, dtype=args.dtype, workers=args.workers)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(benchmark_report, output_file, indent=2)
+    else:
+        json.dump(benchmark_report, sys.stdout, indent=2)
+        print()
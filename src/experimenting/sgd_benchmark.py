@@ -0,0 +1,72 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.recommenders.feedback_matrix import FeedbackMatrix
+from src.recommenders.prediction_algorithms import FACTORISATION_SOLVERS, calc_observed_mse, calc_sgd_model
+
+
+# compares the training engines of calc_sgd_model on the same feedback matrix.
+# e.g. python -m src.experimenting.sgd_benchmark --users 2000 --items 500 --epochs 20
+
+
+def synthetic_feedback(user_count, item_count, density, seed=0) -> pd.DataFrame:
+    """Builds user_id, anime_id, rating feedback of ratings from 1 - 10, for roughly density of all user / item pairs"""
+    rng = np.random.default_rng(seed)
+    # ratings generated from a low rank model plus noise, so there is some structure for the solvers to find
+    user_taste = rng.normal(size=(user_count, 5))
+    item_profile = rng.normal(size=(item_count, 5))
+    ratings = np.clip(np.rint(6.5 + user_taste @ item_profile.T + rng.normal(size=(user_count, item_count))), 1, 10)
+    users, items = np.nonzero(rng.random((user_count, item_count)) <= density)
+    return pd.DataFrame({"user_id": users, "anime_id": items, "rating": ratings[users, items]})
+
+
+def csv_feedback(path, user_count) -> pd.DataFrame:
+    """Loads the feedback of the first user_count users of the anime rating csv"""
+    ratings = pd.read_csv(path)
+    return ratings[(ratings["rating"] > 0) & (ratings["user_id"] <= user_count)]
+
+
+def benchmark(feedback: FeedbackMatrix, solvers, **kwargs):
+    results = []
+    for solver in solvers:
+        np.random.seed(0)
+        start = time.perf_counter()
+        model = calc_sgd_model(feedback, solver=solver, **kwargs)
+        elapsed = time.perf_counter() - start
+        mse = calc_observed_mse(model.user_factors, model.item_factors,
+                                feedback.user_index, feedback.item_index, feedback.ratings)
+        results.append((solver, elapsed, mse))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time each calc_sgd_model solver and report its final MSE")
+    parser.add_argument("--csv", help="path to rating.csv, synthetic data is used if this isn't given")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=500)
+    parser.add_argument("--density", type=float, default=0.05)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--latent-features", type=int, default=75)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=1, help="processes to train 'sgd' and 'minibatch' on")
+    parser.add_argument("--solvers", nargs="+", choices=FACTORISATION_SOLVERS, default=list(FACTORISATION_SOLVERS))
+    args = parser.parse_args()
+
+    if args.csv:
+        feedback = FeedbackMatrix(csv_feedback(args.csv, args.users))
+    else:
+        feedback = FeedbackMatrix(synthetic_feedback(args.users, args.items, args.density))
+
+    print(f"feedback matrix: {feedback.shape[0]} users x {feedback.shape[1]} items, {len(feedback)} ratings")
+    # accepted_deviation of 0 and no early stopping so every solver runs for exactly the same number of epochs,
+    # on all of the ratings
+    timings = benchmark(feedback, args.solvers, max_epoch_count=args.epochs,
+                        latent_feature_count=args.latent_features, accepted_deviation=0.0,
+                        batch_size=args.batch_size, validation_fraction=0.0, patience=None, workers=args.workers)
+
+    print(f"{'solver':<10}{'seconds':>10}{'final MSE':>12}")
+    for solver, seconds, mse in timings:
+        print(f"{solver:<10}{seconds:>10.2f}{mse:>12.4f}")
@@ -12,8 +12,8 @@ class FlaskApp(ABC):
     def run(self, host='127.0.0.1', port=8000, debug=True):
         self.app.run(host=host, port=port, debug=debug)
 
-    def add_endpoint(self, endpoint, endpoint_name, handler):
-        self.app.add_url_rule(endpoint, endpoint_name, handler)
+    def add_endpoint(self, endpoint, endpoint_name, handler, methods=None):
+        self.app.add_url_rule(endpoint, endpoint_name, handler, methods=methods)
 
     @abstractmethod
     def add_all_endpoints(self):
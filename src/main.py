@@ -1,7 +1,8 @@
 import logging
 
 from src.database.csv_processes import reset_anime_table
-from src.database.data import get_connection_psycopg, DatabaseCustomORM, PsycopCursor
+from src.database.data import get_connection_pool_psycopg, DatabaseCustomORM
+from src.myconstants import DB_MAX_CONNECTIONS
 from src.recommender_app import RecommenderApp
 
 
@@ -10,16 +11,17 @@ logging.basicConfig(level=logging.DEBUG, format=logging_format)
 
 
 # creating FApp and connecting to database
-connection = get_connection_psycopg("database/database.ini")
-cursor = PsycopCursor(connection.cursor())
+# requests are handled on multiple threads, so each query checks out its own connection from a shared pool
+pool = get_connection_pool_psycopg("database/database.ini", max_connections=DB_MAX_CONNECTIONS)
 
-reset_anime_table(connection)
+with pool.connection() as connection:
+    reset_anime_table(connection)
 
-db = DatabaseCustomORM(cursor)
+db = DatabaseCustomORM(pool)
 
 app = RecommenderApp(__name__, db)
 
 if __name__ == "__main__":
     app.run(debug=False)
 
-connection.close()
+pool.close()
@@ -1,4 +1,18 @@
 DEFAULT_TOPN = 10
 DEFAULT_COLLAB_WEIGHT = 10.0
 KITSUANIME_APIBASE = 'https://kitsu.io/api/edge/'
-PROD = False
\ No newline at end of file
+PROD = False
+RETRAIN_INTERVAL_SECONDS = 60 * 60
+RETRAIN_RATING_THRESHOLD = 500
+SNAPSHOT_DIRECTORY = './snapshots'
+SNAPSHOT_KEEP_COUNT = 3
+DB_MAX_CONNECTIONS = 10
+RATING_POLL_INTERVAL_SECONDS = 5
+HYBRID_WORKERS = 8
+HYBRID_CHILD_TIMEOUT_SECONDS = 2.0
+BATCH_RECOMMENDATION_SIZE = 1024
+RECOMMENDATION_CACHE_TOP_K = 50
+RECOMMENDATION_CACHE_SIZE = 100_000
+RECOMMENDATION_CACHE_WARM_USERS = 10_000
+# biased factors need far fewer latent features, and float32 halves their memory
+COLLAB_TRAINING_OPTIONS = {"biased": True, "latent_feature_count": 20, "gamma": 0.1, "dtype": "float32", "seed": 0}
@@ -1,17 +1,32 @@
+import json
 import logging
-import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import request, jsonify
+import numpy as np
+import pandas as pd
+from flask import Response, request, jsonify
 
-from src.database.data import DatabaseCustomORM, fetch_anime_data, fetch_feedback_data, fetch_one_feedback_data
+from src.database.change_tracker import RatingChangeTracker
+from src.database.data import DatabaseCustomORM, fetch_anime_data, fetch_feedback_data, fetch_latest_rating_update, \
+    fetch_rating_changes
 from src.flask_app import FlaskApp
+from src.myconstants import BATCH_RECOMMENDATION_SIZE, COLLAB_TRAINING_OPTIONS, DEFAULT_TOPN, \
+    HYBRID_CHILD_TIMEOUT_SECONDS, HYBRID_WORKERS, RATING_POLL_INTERVAL_SECONDS, RECOMMENDATION_CACHE_SIZE, \
+    RECOMMENDATION_CACHE_TOP_K, RECOMMENDATION_CACHE_WARM_USERS, RETRAIN_INTERVAL_SECONDS, RETRAIN_RATING_THRESHOLD, \
+    SNAPSHOT_DIRECTORY, SNAPSHOT_KEEP_COUNT
 from src.recomender_route import recommender_route
 from src.recommenders.collaborative_recommender import CollabRecommender
 from src.recommenders.content_recommender import ContentRecommender
+from src.recommenders.dataset import Dataset
 from src.recommenders.hybrid_recommender import HybridRecommender
+from src.recommenders.model_snapshot import load_latest_snapshot, save_snapshot
 from src.recommenders.popularity_recommender import PopularityRecommender
+from src.recommenders.rating_index import RatingIndex
+from src.recommenders.recommendation_cache import RecommendationCache
 from src.recommenders.recommendation_engine import RecommendationEngine
-from src.utils import filter_by_query, get_query_vars
+from src.recommenders.training_scheduler import TrainingScheduler
+from src.utils import get_query_vars
 
 
 class RecommenderApp(FlaskApp):
@@ -20,19 +35,66 @@ class RecommenderApp(FlaskApp):
     def __init__(self, name, db: DatabaseCustomORM):
         super().__init__(name)
         self.db = db
-        self.items_df = fetch_anime_data(db)
-        self.feedback_df = fetch_feedback_data(db)
-
-        content_r = ContentRecommender(self.items_df, self.feedback_df)
-        collab_r = CollabRecommender(self.items_df, self.feedback_df)
-        hybrid_r = HybridRecommender(self.items_df, self.feedback_df, [(content_r, 1.0), (collab_r, 2.0)])
-
-        self.popularity_r = PopularityRecommender()
-
-        self.engine = RecommendationEngine(self.items_df, self.feedback_df,
+        # one copy of the shows and ratings, in compact types, that every recommender shares.
+        # rating timestamps aren't used by any recommender, so only the latest one is kept.
+        # it's read before the ratings are, so any rating changed while they load is newer than it,
+        # and gets picked up by the change tracker rather than missed
+        latest_update = fetch_latest_rating_update(db)
+        self.dataset = Dataset(fetch_anime_data(db), fetch_feedback_data(db, timestamps=False),
+                               latest_update=latest_update)
+        logging.info(f"Dataset loaded, memory usage in bytes: {self.dataset.memory_usage()}")
+        # every recommender looks users' ratings up in the same index, rather than each scanning the ratings
+        self.rating_index = rating_index = RatingIndex(self.dataset.ratings)
+
+        # only train from scratch if there isn't a snapshot to start from. one that's older than the ratings just
+        # has the ratings changed since it was saved folded into it, as they would have been had the app kept running
+        snapshot = load_latest_snapshot(SNAPSHOT_DIRECTORY, self.dataset.item_ids)
+        changed_since_snapshot = 0
+        if snapshot is None:
+            logging.info("No model snapshot, training recommenders")
+            content_r = ContentRecommender(self.dataset, rating_index=rating_index)
+            collab_r = CollabRecommender(self.dataset, rating_index=rating_index, **COLLAB_TRAINING_OPTIONS)
+        else:
+            content_r = ContentRecommender(self.dataset, rating_index=rating_index, **(snapshot["content"] or {}))
+            collab_r = CollabRecommender(self.dataset, model=snapshot["collab_model"], rating_index=rating_index,
+                                         **COLLAB_TRAINING_OPTIONS)
+            changed_since_snapshot = self.fold_in_changes_since(collab_r, snapshot["watermark"])
+        self.content_r, self.collab_r = content_r, collab_r
+        if snapshot is None:
+            self.save_snapshot(latest_update)
+        # every retrain is saved too, so the next startup has as little as possible to fold in.
+        # the change tracker's watermark is read before the model is, so any change applied after it is treated
+        # as not being in the model
+        collab_r.model_swap_listeners.append(lambda: self.save_snapshot(self.change_tracker.watermark))
+        # the hybrid's recommenders are scored side by side, so it takes as long as the slowest rather than both
+        self.hybrid_executor = ThreadPoolExecutor(max_workers=HYBRID_WORKERS, thread_name_prefix="hybrid")
+        hybrid_r = HybridRecommender(self.dataset, [(content_r, 1.0), (collab_r, 2.0)],
+                                     rating_index=rating_index, executor=self.hybrid_executor,
+                                     child_timeout=HYBRID_CHILD_TIMEOUT_SECONDS, max_in_flight=HYBRID_WORKERS)
+
+        self.popularity_r = PopularityRecommender(self.dataset.items)
+
+        self.engine = RecommendationEngine(self.dataset,
                                            recommenders={"content_recommender": content_r,
                                                          "collab_recommender": collab_r,
-                                                         "hybrid_recommender": hybrid_r})
+                                                         "hybrid_recommender": hybrid_r},
+                                           cache=RecommendationCache(RECOMMENDATION_CACHE_TOP_K,
+                                                                     RECOMMENDATION_CACHE_SIZE))
+        # precompute the most active users' recommendations in the background, without holding up startup
+        threading.Thread(target=self.engine.warm_cache, name="recommendation-cache-warm-up", daemon=True,
+                         args=(rating_index.most_active_users(RECOMMENDATION_CACHE_WARM_USERS),)).start()
+
+        # the collaborative model is retrained in the background, never on a request thread
+        self.training_scheduler = TrainingScheduler(collab_r, interval=RETRAIN_INTERVAL_SECONDS,
+                                                    rating_threshold=RETRAIN_RATING_THRESHOLD)
+        # ratings folded in on top of a snapshot count towards the next retrain, just like any other change
+        self.training_scheduler.notify_new_ratings(changed_since_snapshot)
+        self.training_scheduler.start()
+
+        # rating changes are picked up in the background too, so requests never have to check the database for them
+        self.change_tracker = RatingChangeTracker(db, self.apply_rating_changes, interval=RATING_POLL_INTERVAL_SECONDS,
+                                                  watermark=self.dataset.latest_update or pd.Timestamp(0))
+        self.change_tracker.start()
 
     def add_all_endpoints(self):
         self.add_endpoint(endpoint="/", endpoint_name="/", handler=self.index)
@@ -45,40 +107,119 @@ class RecommenderApp(FlaskApp):
                           handler=self.collab_recommender_route)
         self.add_endpoint(endpoint="/hybrid-recommender/<int:user_id>", endpoint_name="/hybrid-recommender",
                           handler=self.hybrid_recommender_route)
-
-    def try_update_ratings(self, user_id: int):
-        old_user_ratings = self.feedback_df[self.feedback_df["user_id"] == user_id]
-        new_user_ratings = fetch_one_feedback_data(self.db, user_id)
-
-        if old_user_ratings["rating"].sum() != new_user_ratings["rating"].sum():
-            logging.debug("New ratings detected, Refreshing recommenders")
-            updated_ratings = fetch_feedback_data(self.db)
-            self.engine.refresh_recommenders(updated_ratings)
+        self.add_endpoint(endpoint="/batch-recommendations/<recommender_name>",
+                          endpoint_name="/batch-recommendations", handler=self.batch_recommendations_route,
+                          methods=["POST"])
+        self.add_endpoint(endpoint="/metrics", endpoint_name="/metrics", handler=self.metrics_route)
+
+    def fold_in_changes_since(self, collab_r: CollabRecommender, watermark) -> int:
+        """
+        Folds the loaded ratings of every user with ratings changed at or after watermark into the model,
+        so a model loaded from a snapshot is as up to date as the ratings
+        Returns: the number of users folded in, each with at least one changed rating
+        """
+        user_ids, _, _ = fetch_rating_changes(self.db, pd.Timestamp(0) if watermark is None else watermark)
+        for user_id in user_ids.tolist():
+            anime_ids, ratings = self.rating_index.get_user_ratings(user_id)
+            collab_r.update_user(user_id, pd.DataFrame({"anime_id": anime_ids, "rating": ratings}))
+        logging.info(f"Folded {len(user_ids)} users' rating changes into the model snapshot")
+        return len(user_ids)
+
+    def save_snapshot(self, watermark):
+        """
+        Saves the recommenders' trained state. A failure is only logged, as the app carries on fine without it
+        @param watermark: the latest rating update the model has taken in
+        """
+        try:
+            save_snapshot(SNAPSHOT_DIRECTORY, watermark, self.content_r, self.collab_r, keep=SNAPSHOT_KEEP_COUNT)
+        except Exception:
+            logging.exception("Saving the model snapshot failed")
+
+    def apply_rating_changes(self, user_ids, user_ratings: pd.DataFrame) -> int:
+        """
+        Brings the recommenders up to date with users' changed ratings. Called by the change tracker.
+        @param user_ids: the users with changed ratings
+        @param user_ratings: every watched rating those users now have
+        Returns: the number of those users whose ratings had actually changed
+        """
+        new_by_user = dict(tuple(user_ratings.groupby("user_id")))
+
+        # users can come up again without any actual change, e.g. when updatedAt is touched but the rating isn't
+        changed_users, new_rating_count = [], 0
+        for user_id in user_ids:
+            new_ratings = new_by_user.get(user_id, user_ratings.iloc[:0])
+            new_pairs = set(zip(new_ratings["anime_id"], new_ratings["rating"]))
+            old_pairs = set(zip(*self.rating_index.get_user_ratings(user_id)))
+            if new_pairs != old_pairs:
+                changed_users.append((user_id, new_ratings))
+                new_rating_count += len(new_pairs - old_pairs)
+        if not changed_users:
+            return 0
+
+        logging.debug(f"New ratings detected, updating recommenders for {len(changed_users)} users")
+        # only these users' ratings are swapped in, in the rating index. self.dataset keeps the ratings loaded at
+        # startup, so a change costs as much as the user has ratings, and the full set of ratings is only put
+        # together again when the next retrain starts
+        for user_id, new_ratings in changed_users:
+            self.engine.update_user_ratings(user_id, new_ratings)
+
+        # count the new or changed ratings towards the next retrain
+        self.training_scheduler.notify_new_ratings(new_rating_count)
+        return len(changed_users)
 
     def index(self):
         return "Welcome to the film recommender API"
 
+    def metrics_route(self):
+        return jsonify({"collab_training": self.training_scheduler.metrics(),
+                        "rating_changes": self.change_tracker.metrics(),
+                        "hybrid_degraded_count": self.engine.get_recommender("hybrid_recommender").degraded_count,
+                        "recommendation_cache": self.engine.cache.metrics(),
+                        "dataset_memory_bytes": self.dataset.memory_usage()})
+
     def content_recommender_route(self, user_id: int):
-        self.try_update_ratings(user_id)
-        return recommender_route(user_id, self.engine.get_recommender("content_recommender"))
+        return recommender_route(user_id, self.engine, "content_recommender")
 
     def collab_recommender_route(self, user_id: int):
-        self.try_update_ratings(user_id)
-        return recommender_route(user_id, self.engine.get_recommender("collab_recommender"))
+        return recommender_route(user_id, self.engine, "collab_recommender")
 
     def hybrid_recommender_route(self, user_id: int):
-        self.try_update_ratings(user_id)
-        return recommender_route(user_id, self.engine.get_recommender("hybrid_recommender"))
+        return recommender_route(user_id, self.engine, "hybrid_recommender")
+
+    def batch_recommendations_route(self, recommender_name: str):
+        """
+        Recommendations for many users in one request. Takes a JSON body of
+        {"user_ids": [...], "recommendationCount": n}, and streams back one JSON line per user as
+        {"user_id": ..., "recommendations": [{"anime_id": ..., <score column>: ...}, ...]}
+        """
+        recommender = self.engine.get_recommender(recommender_name)
+        if recommender is None:
+            return jsonify({"error": f"there is no recommender called {recommender_name}"}), 404
+        body = request.get_json(silent=True) or {}
+        try:
+            user_ids = np.array(body.get("user_ids", []), dtype=np.int64).reshape(-1)
+            recommendation_count = int(body.get("recommendationCount", DEFAULT_TOPN))
+        except (TypeError, ValueError):
+            return jsonify({"error": "user_ids must be a list of user ids, and recommendationCount a number"}), 400
+        score_column = recommender.get_score_column_name()
+
+        def generate_lines():
+            # users are recommended for a batch at a time, each batch being sent on as soon as it's done
+            for start in range(0, len(user_ids), BATCH_RECOMMENDATION_SIZE):
+                batch = user_ids[start:start + BATCH_RECOMMENDATION_SIZE]
+                top_ids, top_scores = self.engine.generate_recommendations_batch(recommender_name, batch,
+                                                                                 recommendation_count)
+                for user_id, user_top_ids, user_top_scores in zip(batch.tolist(), top_ids.tolist(),
+                                                                  top_scores.tolist()):
+                    recs = [{"anime_id": anime_id, score_column: score}
+                            for anime_id, score in zip(user_top_ids, user_top_scores) if anime_id != -1]
+                    yield json.dumps({"user_id": user_id, "recommendations": recs}) + "\n"
+
+        return Response(generate_lines(), mimetype="application/x-ndjson")
 
     def popularity_recommender_route(self):
         recommendation_count, verbose = get_query_vars()
-        filtered_shows = None
-        if query := request.args.get('query'):
-            regex_string = query.replace(',', '|')
-            filtered_shows = filter_by_query('genre', lambda x: bool(
-                re.search(regex_string, x, re.IGNORECASE)), self.items_df)
-
-        shows = filtered_shows if (filtered_shows is not None) else self.items_df
-        recs = self.popularity_r.generate_recommendations(
-            shows, recommendation_count, verbose)
+        # ?query= is a comma separated list of genres, any of which a show can have to be recommended
+        genres = query.split(',') if (query := request.args.get('query')) else None
+        recs = self.popularity_r.generate_recommendations(recommendation_count, verbose, genres)
         return jsonify({"recommendations": recs.to_dict('records')})
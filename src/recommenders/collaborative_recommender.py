@@ -1,52 +1,173 @@
+import threading
+import time
+
 import numpy as np
 import pandas as pd
 
-from src.recommenders.prediction_algorithms import calc_sgd_predictions
+from src.recommenders.dataset import Dataset
+from src.recommenders.feedback_matrix import FeedbackMatrix
+from src.recommenders.factor_model import FactorModel
+from src.recommenders.prediction_algorithms import calc_sgd_model, solve_factor_row
+from src.recommenders.rating_index import RatingIndex
 from src.recommenders.recommender import Recommender
+from src.utils import exclusion_mask, top_n_indices
 
 
 class CollabRecommender(Recommender):
 
-    def __init__(self, shows: pd.DataFrame, ratings: pd.DataFrame) -> None:
-        super().__init__(shows, ratings)
+    def __init__(self, dataset: Dataset, model: FactorModel = None, rating_index: RatingIndex = None,
+                 **training_options) -> None:
+        """
+        @param model: an already trained model for these ratings, e.g. loaded from a snapshot.
+        If given, no training happens on construction
+        @param training_options: keyword arguments passed on to calc_sgd_model every time the model is trained
+        """
+        super().__init__(dataset, rating_index)
+        self.training_options = training_options
+
+        # guards self.model against being swapped out part way through a user's ratings being folded into it
+        self.__update_lock = threading.Lock()
+        # while a retrain is running, the latest ratings of every user folded into the old model since it started
+        self.__updated_users = None
+        # (model, position in the model of each of self.item_ids, -1 if it isn't in it), worked out once per model
+        self.__item_alignment = None
+
+        # train the model. Only the user and item factors are kept,
+        # predictions are calculated from them per user as recommendations are requested.
+        # the feedback matrix is only needed for training, so it's never kept afterwards
+        self.model = self.__train_model(self.ratings) if model is None else model
+
+    def __train_model(self, ratings, **overrides) -> FactorModel:
+        start = time.perf_counter()
+        # sparse userId x animeId matrix of only the ratings that have been left.
+        # a dense pivot of this is almost entirely zeros, and far too big to fit in memory for the full dataset
+        feedback = FeedbackMatrix(ratings)
+        model = calc_sgd_model(feedback, **{**self.training_options, **overrides})
+        model.training_seconds = time.perf_counter() - start
+        model.trained_at = time.time()
+        return model
+
+    def __fold_in_user(self, model: FactorModel, user_id, user_ratings: pd.DataFrame):
+        known_items = user_ratings[user_ratings["anime_id"].isin(model.item_positions.keys())]
+        if known_items.empty:
+            return
+        item_positions = [model.item_positions[anime_id] for anime_id in known_items["anime_id"]]
+        item_factors = model.item_factors[item_positions].astype(np.float64)
+        ratings = known_items["rating"].to_numpy(dtype=np.float64)
+        gamma = self.training_options.get("gamma", 0.4)
+        if model.biased:
+            # solve for the user's factors and bias against how far their ratings are from the mean and item biases,
+            # leaving out the items' bias column, which users always multiply by 1
+            user_factors = solve_factor_row(item_factors[:, :-1], ratings - model.global_mean - item_factors[:, -1],
+                                            gamma)
+            user_factors = np.append(user_factors, 1.0)
+            user_factors[-2] += model.global_mean
+        else:
+            user_factors = solve_factor_row(item_factors, ratings, gamma)
+        model.set_user_factors(user_id, user_factors)
+
+    def retrain(self, **overrides) -> FactorModel:
+        """
+        Trains a new model from the current ratings and swaps it in for the old one.
+        Those are the rating index's, as users' changed ratings only ever go into it, never into the dataset.
+        Safe to call from a background thread: the old model keeps serving recommendations until the new one is
+        complete, and the swap is a single reference assignment, so a request never sees a half trained model.
+
+        @param overrides: training options to use for just this training run
+        Returns: the new model
+        """
+        with self.__update_lock:
+            self.__updated_users = {}
+        # anyone whose ratings change from here on is recorded in self.__updated_users, so those are all that
+        # have to be caught by the ratings read next. Compacting the index while reading them stops
+        # its overrides growing with every user updated between retrains
+        ratings = self.rating_index.compact()
 
-        # pivot data from userId - animeId - rating as columns to 
-        # userId as rows, animeId as columns, rating as values 
-        self.feedback_df = self.ratings.pivot_table(
-            index="user_id", columns="anime_id", values="rating", fill_value=0.0, aggfunc=np.mean).astype('float')
+        model = self.__train_model(ratings, **overrides)
 
-        # calculate predictions
-        # for now, this only needs to happen once: on startup.
-        self.predictions_df = self.__init_prediction_df()
+        with self.__update_lock:
+            # anyone whose ratings changed during training was folded into the old model, but not this one
+            for user_id, user_ratings in self.__updated_users.items():
+                self.__fold_in_user(model, user_id, user_ratings)
+            self.__updated_users = None
+            self.model = model
+        for listener in self.model_swap_listeners:
+            listener()
+        return model
 
-    def __init_prediction_df(self, **kwargs):
-        predictions_matrix = calc_sgd_predictions(self.feedback_df, **kwargs)
-        return pd.DataFrame(
-            predictions_matrix, index=self.feedback_df.index, columns=self.feedback_df.columns)
+    def predict_ratings(self, user_ids) -> pd.DataFrame:
+        """
+        Predicted ratings of every show for several users at once, calculated as one matrix product.
+        Returns: DataFrame with a row per user in user_ids and a column per anime id
+        """
+        model = self.model
+        return pd.DataFrame(model.score_users(user_ids), index=pd.Index(user_ids, name="user_id"),
+                            columns=pd.Index(model.item_ids, name="anime_id"))
+
+    def __get_item_alignment(self, model: FactorModel) -> np.ndarray:
+        alignment = self.__item_alignment
+        if alignment is None or alignment[0] is not model:
+            positions = np.array([model.item_positions.get(item_id, -1) for item_id in self.item_ids.tolist()],
+                                 dtype=np.int64)
+            # a single assignment, so other threads see either the old model's alignment or this one
+            self.__item_alignment = alignment = (model, positions)
+        return alignment[1]
+
+    def score_items(self, user_id: int) -> np.ndarray:
+        model = self.model
+        scores = np.full(len(self.item_ids), np.nan)
+        if user_id not in model:
+            return scores
+        # the model only has factors for shows that have been rated, the rest of self.item_ids stay NaN
+        positions = self.__get_item_alignment(model)
+        known = positions != -1
+        scores[known] = model.score_user(user_id)[positions[known]]
+        return scores
+
+    def score_items_batch(self, user_ids) -> np.ndarray:
+        model = self.model
+        scores = np.full((len(user_ids), len(self.item_ids)), np.nan)
+        user_positions = np.array([model.user_positions.get(user_id, -1) for user_id in user_ids], dtype=np.int64)
+        item_positions = self.__get_item_alignment(model)
+        known_users, known_items = np.flatnonzero(user_positions != -1), np.flatnonzero(item_positions != -1)
+        # every known user against every known item as one matrix product
+        scores[np.ix_(known_users, known_items)] = (model.user_factors[user_positions[known_users]]
+                                                    @ model.item_factors[item_positions[known_items]].T)
+        return scores
 
     # overridden
     def generate_recommendations(self, user_id: int, recommendation_count: int = 10, verbose: bool = False,
                                  items_to_ignore=None) -> pd.DataFrame:
-        # find the requested users recommendations
-        if items_to_ignore is None:
-            items_to_ignore = []
-        requested_users_recs = self.predictions_df.loc[user_id]
+        # use the same model throughout, even if a new one is swapped in part way through
+        model = self.model
+        if user_id not in model:  # none of this user's ratings are for shows the model knows about
+            return pd.DataFrame(columns=["anime_id", "predicted_rating"])
 
-        # remove any items from items_to_ignore
-        filtered_recs = requested_users_recs.filter(items=(set(requested_users_recs.index) - set(items_to_ignore)))
+        # find the requested users recommendations
+        scores = model.score_user(user_id)
 
-        # sort by recommendation score and give us the top {recommendation_count}
-        top_shows = filtered_recs.sort_values(ascending=False).to_frame(name="predicted_rating")[
-                    :min(recommendation_count, len(filtered_recs))]
+        # remove any items from items_to_ignore, and give us the top {recommendation_count} by recommendation score
+        ignored = exclusion_mask(model.item_positions, len(scores), items_to_ignore)
+        top = top_n_indices(scores, recommendation_count, ignored)
+        top_shows = pd.DataFrame({"anime_id": model.item_ids[top], "predicted_rating": scores[top]})
 
         if verbose:  # add all other show data if requested
-            top_shows = top_shows.merge(self.shows[self.shows["anime_id"].isin(
-                filtered_recs.keys())], how="left", left_on="anime_id", right_on="anime_id")
-        top_shows.reset_index(level=0, inplace=True)
+            top_shows = top_shows.merge(self.shows, how="left", left_on="anime_id", right_on="anime_id")
         return top_shows
 
     def refresh(self):
-        self.predictions_df = self.__init_prediction_df(alpha=0.02)
+        self.retrain(alpha=0.02)
+
+    def update_user(self, user_id: int, user_ratings: pd.DataFrame):
+        """
+        Folds a user's new ratings into the model without retraining it.
+        Item factors stay as they are, and the user's factors are re-solved to best fit their ratings against them,
+        so this only costs as much as the user has ratings.
+        """
+        with self.__update_lock:
+            self.__fold_in_user(self.model, user_id, user_ratings)
+            if self.__updated_users is not None:
+                self.__updated_users[user_id] = user_ratings
 
     def get_score_column_name(self) -> str:
         return "predicted_rating"
@@ -1,77 +1,94 @@
+import threading
+
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
 
-from src.recommenders.prediction_algorithms import calculate_similarity_score, calculate_term_frequencies, \
-    calculate_item_embeddings
+from src.recommenders.dataset import Dataset
+from src.recommenders.prediction_algorithms import calculate_item_embedding_matrix, calculate_user_embedding_vector
+from src.recommenders.rating_index import RatingIndex
 from src.recommenders.recommender import Recommender
+from src.utils import exclusion_mask, top_n_indices
 
 
 class ContentRecommender(Recommender):
 
-    def __init__(self, shows: pd.DataFrame, ratings: pd.DataFrame):
-        super().__init__(shows, ratings)
-        self.genre_frequencies = calculate_term_frequencies(shows, "genre")
-        self.show_embeddings = calculate_item_embeddings(shows)
-
-    def __calculate_user_embedding(self, user_id) -> dict:
+    def __init__(self, dataset: Dataset, genre_frequencies: dict = None, show_genres: csr_matrix = None,
+                 show_embeddings: csr_matrix = None, rating_index: RatingIndex = None):
+        """
+        genre_frequencies, show_genres and show_embeddings can be passed in if they've already been calculated
+        for these shows, e.g. loaded from a snapshot, otherwise they're calculated here
+        from the dataset's genre bits.
+        """
+        super().__init__(dataset, rating_index)
+        if genre_frequencies is None:
+            genre_frequencies = dataset.genre_frequencies()
+        self.genre_frequencies = genre_frequencies
+        # fixed genre order, so embeddings can be held as vectors with one element per genre
+        self.genres = sorted(self.genre_frequencies)
+        self.genre_frequency_vector = np.array([self.genre_frequencies[genre] for genre in self.genres],
+                                               dtype=np.float64)
+
+        # shows x genres matrices. These should never need to be changed.
+        if show_genres is None:
+            show_genres = dataset.genre_matrix()
+        if show_embeddings is None:
+            show_embeddings = calculate_item_embedding_matrix(show_genres, self.genre_frequency_vector)
+        self.show_genres = show_genres
+        self.show_embeddings = show_embeddings
+
+        # an embedding is only stored if the user's ratings haven't changed while it was being calculated,
+        # which these versions tell, as in RecommendationCache: bumped for one user by update_user, for all by refresh
+        self.__embedding_lock = threading.Lock()
+        self.__embedding_generation = 0
+        self.__embedding_versions = {}
+
+    def __calculate_user_embedding(self, user_id) -> np.ndarray:
         """Generates the embedding for the user with id = user_id.\n
         Stores the result in self.user_embeddings[user_id]
         so it need not be generated again and can be updated easily when reviews are left.
 
         Keyword arguments:\n
         user_id -- the id of the user who's embedding you want to generate
-        Return: Calculated user embedding
+        Return: Calculated user embedding, a vector of scores ordered as self.genres
         """
-        embedding = {}
-
-        rating_df_cols = list(self.ratings.columns)
-        rating_tuple_anime_id_index = rating_df_cols.index("anime_id")  # index of id column once df is numpy-ified
-        rating_tuple_rating_index = rating_df_cols.index("rating")  # as above but for rating column
+        rated_ids, ratings = self.rating_index.get_user_ratings(user_id)
 
-        # much faster to work with underlying numpy array than the full dataframe, so we convert it here
-        this_users_ratings = np.array(
-            self.ratings[self.ratings["user_id"] == user_id])
+        # rows of the shows this user rated. Anything rated that isn't in self.shows has no genres to contribute
+        rated_positions = [self.item_positions.get(anime_id, -1) for anime_id in rated_ids.tolist()]
+        rated_positions = np.array(rated_positions, dtype=np.int64)
+        known = rated_positions != -1
 
-        for rating in this_users_ratings:  # iterate through user's ratings
-            # extract genre data
-            this_shows_genres = list(
-                self.shows.loc[self.shows["anime_id"] == rating[rating_tuple_anime_id_index]]["genre"])[0].split(", ")
+        return calculate_user_embedding_vector(self.show_genres, rated_positions[known],
+                                               ratings.astype(np.float64)[known], self.genre_frequency_vector)
 
-            for genre in this_shows_genres:
-                if genre not in embedding:  # construct embedding based on genres of the show
-                    embedding[genre] = rating[rating_tuple_rating_index]
-                else:  # increment this genres score proportional to how much the user liked the show it was on
-                    embedding[genre] += rating[rating_tuple_rating_index]
-        # normalise embedding based on genre frequencies.
-        normalized_embedding = {genre: embedding[genre] / (0.5 * self.genre_frequencies[genre])
-                                for genre in embedding.keys() & self.genre_frequencies}
-
-        return normalized_embedding
-
-    def __compare_embeddings(self, user_id) -> dict:
+    def __compare_embeddings(self, user_id) -> np.ndarray:
         """Compares user and show embeddings to find show most similar to user.
+        Gives the same scores as calculate_similarity_score, for every show at once.
 
-        Return: dictionary of form show_id: score, highest being most relevant
+        Return: array of every show's score, ordered as self.item_ids, highest being most relevant
         """
-        embedding_scores: dict = {}
         # retrieve this user's embedding
         user_embedding = self.__get_user_embedding(user_id)
-        # iterate through shows
-        for show_id, show_embedding in self.show_embeddings.items():
-            # dot product user and show embedding to produce score for this show
-
-            embedding_scores[show_id] = calculate_similarity_score(
-                user_embedding, show_embedding, self.genre_frequencies)
-        return embedding_scores
+        user_genre_count = np.count_nonzero(user_embedding)
+        if user_genre_count == 0:  # nothing this user has rated is in self.shows, so nothing to go on
+            return np.zeros(len(self.item_ids))
+        # dot product user and every show embedding to produce a score for each show
+        return (self.show_embeddings @ user_embedding) / user_genre_count
 
     def __get_user_embedding(self, user_id):
         if user_id in self.user_embeddings:
             # This user's embedding has already been generated and stored, so why bother generating it again?
             return self.user_embeddings[user_id]
         else:
+            with self.__embedding_lock:
+                version = self.__embedding_generation, self.__embedding_versions.get(user_id, 0)
             user_embedding = self.__calculate_user_embedding(user_id)
-            # store the newly calculated user embedding so it doesn't need to be calculated again.
-            self.user_embeddings[user_id] = user_embedding
+            # store the newly calculated user embedding so it doesn't need to be calculated again,
+            # unless it was calculated from ratings that have since been replaced
+            with self.__embedding_lock:
+                if version == (self.__embedding_generation, self.__embedding_versions.get(user_id, 0)):
+                    self.user_embeddings[user_id] = user_embedding
             return user_embedding
 
     # overridden
@@ -81,25 +98,44 @@ class ContentRecommender(Recommender):
         # do the actual recommending process and figure out the recommendations
         if items_to_ignore is None:
             items_to_ignore = []
-        scores = self.__compare_embeddings(user_id)
-        # remove any items from items_to_ignore
-        filtered_scores = {sid: score for sid,
-                           score in scores.items() if sid not in items_to_ignore}
-
-        # TODO write this sorting algorithm myself
-        # sort shows based on their recommendation score and then cast to a DataFrame
-        top_shows = pd.DataFrame(sorted(filtered_scores.items(), key=lambda x: x[1], reverse=True)[
-                                 :min(recommendation_count, len(filtered_scores))],
-                                 columns=["anime_id", "relevance_score"])
+        scores = self.score_items(user_id)
+        # remove any items from items_to_ignore, then pick out the best shows based on their recommendation score
+        ignored = exclusion_mask(self.item_positions, len(scores), items_to_ignore)
+        top = top_n_indices(scores, recommendation_count, ignored)
+        top_shows = pd.DataFrame({"anime_id": self.item_ids[top], "relevance_score": scores[top]})
 
         if verbose:  # add all other show data if requested
-            top_shows = top_shows.merge(self.shows[self.shows["anime_id"].isin(
-                filtered_scores.keys())], how="left", left_on="anime_id", right_on="anime_id")
+            top_shows = top_shows.merge(self.shows, how="left", left_on="anime_id", right_on="anime_id")
 
         return top_shows
 
+    def score_items(self, user_id: int) -> np.ndarray:
+        return self.__compare_embeddings(user_id)
+
+    def score_items_batch(self, user_ids) -> np.ndarray:
+        # embeddings already worked out are reused, but new ones aren't stored,
+        # so scoring every user in one go doesn't fill up self.user_embeddings with all of them
+        user_embeddings = np.array([self.user_embeddings[user_id] if user_id in self.user_embeddings
+                                    else self.__calculate_user_embedding(user_id) for user_id in user_ids])
+        user_embeddings = user_embeddings.reshape(len(user_ids), len(self.genres))
+        user_genre_counts = np.count_nonzero(user_embeddings, axis=1)
+        # every user against every show as one sparse x dense matrix product, users x shows
+        scores = np.asarray(self.show_embeddings @ user_embeddings.T).T
+        # users with no genres get all zeros, as in __compare_embeddings
+        return np.divide(scores, user_genre_counts[:, np.newaxis], out=np.zeros_like(scores),
+                         where=user_genre_counts[:, np.newaxis] != 0)
+
     def refresh(self):
-        self.user_embeddings.clear()
+        with self.__embedding_lock:
+            self.__embedding_generation += 1
+            self.__embedding_versions.clear()
+            self.user_embeddings.clear()
+
+    def update_user(self, user_id: int, user_ratings: pd.DataFrame):
+        # only this user's embedding is out of date, it'll be recalculated next time it's needed
+        with self.__embedding_lock:
+            self.__embedding_versions[user_id] = self.__embedding_versions.get(user_id, 0) + 1
+            self.user_embeddings.pop(user_id, None)
 
     def get_score_column_name(self) -> str:
         return "relevance_score"
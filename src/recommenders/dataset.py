@@ -0,0 +1,80 @@
+import zlib
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from src.recommenders.prediction_algorithms import calculate_genre_matrix
+
+
+def calculate_data_version(items: pd.DataFrame, ratings: pd.DataFrame, latest_update=None) -> str:
+    """
+    Cheap identifier for a particular state of the anime and rating tables:
+    row counts, the latest rating update, and a checksum of the id and rating columns.
+    """
+    checksum = 0
+    for column in (items["anime_id"], ratings["user_id"], ratings["anime_id"], ratings["rating"]):
+        checksum = zlib.crc32(column.to_numpy(dtype=np.int64).tobytes(), checksum)
+    latest_update = 0 if latest_update is None else pd.Timestamp(latest_update).value
+    return f"{len(items)}-{len(ratings)}-{latest_update}-{checksum:08x}"
+
+
+class Dataset:
+    """
+    The shows and ratings every recommender is built on, held once and shared by reference.
+    Columns are expected in the compact types fetch_anime_data / fetch_feedback_data load them as:
+    int32 ids, int8 ratings, categorical show type and genre, and no rating timestamps.
+    Each show's genres are also kept as a multi-hot bit array, one bit per genre, packed 8 to a byte.
+    """
+
+    def __init__(self, items: pd.DataFrame, ratings: pd.DataFrame, latest_update=None):
+        """
+        @param items: anime DataFrame
+        @param ratings: feedback DataFrame with user_id, anime_id and rating columns
+        @param latest_update: when the most recently updated of ratings was updated, kept in place of every timestamp
+        """
+        self.items = items
+        self.ratings = ratings
+        self.latest_update = None if latest_update is None else pd.Timestamp(latest_update)
+        self.__fingerprint = None
+
+        # fixed show order that everything built on this dataset scores shows in
+        self.item_ids: np.ndarray = items["anime_id"].to_numpy()
+        self.item_positions: dict = {item_id: position for position, item_id in enumerate(self.item_ids.tolist())}
+
+        # shows x genres bits, each row packed into len(genres) / 8 bytes
+        self.genres: list = sorted(items["genre"].str.split(", ").explode().dropna().unique())
+        self.genre_bits: np.ndarray = np.packbits(calculate_genre_matrix(items, self.genres).toarray() > 0, axis=1)
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Identifies exactly these shows and ratings, see calculate_data_version.
+        Worked out the first time it's needed and kept, so comparing two datasets' fingerprints is O(1)
+        """
+        if self.__fingerprint is None:
+            self.__fingerprint = calculate_data_version(self.items, self.ratings, self.latest_update)
+        return self.__fingerprint
+
+    def is_compatible(self, other: 'Dataset') -> bool:
+        """whether other holds the same shows and ratings as this dataset"""
+        return other is self or other.fingerprint == self.fingerprint
+
+    def genre_matrix(self) -> csr_matrix:
+        """The genre bits unpacked into a sparse shows x genres matrix of 1s, columns ordered as self.genres"""
+        return csr_matrix(np.unpackbits(self.genre_bits, axis=1, count=len(self.genres)).astype(np.float64))
+
+    def genre_frequencies(self) -> dict:
+        """genre: number of shows listing it"""
+        counts = np.unpackbits(self.genre_bits, axis=1, count=len(self.genres)).sum(axis=0)
+        return {genre: int(count) for genre, count in zip(self.genres, counts)}
+
+    def memory_usage(self) -> dict:
+        """Bytes held by each part of the dataset, strings and all"""
+        usage = {
+            "items": int(self.items.memory_usage(deep=True).sum()),
+            "ratings": int(self.ratings.memory_usage(deep=True).sum()),
+            "genre_bits": int(self.genre_bits.nbytes),
+        }
+        usage["total"] = sum(usage.values())
+        return usage
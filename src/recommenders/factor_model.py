@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class FactorModel:
+    """
+    A trained matrix factorisation: one row of latent factors per user and one per item.
+    The full users x items prediction matrix is never stored, a user's predicted ratings are
+    calculated from these factors only when they are asked for.
+
+    A biased model keeps the mean rating and each user's and item's bias in two extra columns on the end:
+    users have [factors..., global mean + user bias, 1] and items have [factors..., 1, item bias],
+    so a user and item's dot product is their predicted rating with every bias included, just like an unbiased one.
+    """
+
+    def __init__(self, user_ids: np.ndarray, item_ids: np.ndarray, user_factors: np.ndarray,
+                 item_factors: np.ndarray, global_mean: float = None):
+        """
+        @param user_ids: id of the user each row of user_factors belongs to
+        @param item_ids: id of the item each row of item_factors belongs to
+        @param user_factors: users x latent_feature_count matrix
+        @param item_factors: items x latent_feature_count matrix
+        @param global_mean: the mean rating, if this is a biased model, otherwise None
+        """
+        self.global_mean = global_mean
+        self.item_ids = item_ids
+        self.item_factors = item_factors
+        # user rows are kept in buffers with spare room on the end, so new users can be added cheaply.
+        # user_ids / user_factors are views of just the rows in use.
+        self.__user_id_buffer = user_ids
+        self.__user_factor_buffer = user_factors
+        self.user_ids = user_ids
+        self.user_factors = user_factors
+        self.user_positions: dict = {user_id: position for position, user_id in enumerate(user_ids.tolist())}
+        self.item_positions: dict = {item_id: position for position, item_id in enumerate(item_ids.tolist())}
+
+        # when this model was trained (unix time) and how long it took, filled in by whoever trains it
+        self.trained_at = None
+        self.training_seconds = None
+        # train / validation error after each epoch of training, see calc_latent_factors
+        self.training_curve = None
+
+    @property
+    def biased(self) -> bool:
+        return self.global_mean is not None
+
+    def __contains__(self, user_id):
+        return user_id in self.user_positions
+
+    def score_user(self, user_id) -> np.ndarray:
+        """
+        Predicted rating of every item for one user, ordered as self.item_ids
+        """
+        return self.user_factors[self.user_positions[user_id]] @ self.item_factors.T
+
+    def score_users(self, user_ids) -> np.ndarray:
+        """
+        Predicted ratings for many users at once as a single matrix product.
+        Returns: len(user_ids) x items matrix, rows in the order of user_ids and columns ordered as self.item_ids
+        """
+        positions = [self.user_positions[user_id] for user_id in user_ids]
+        return self.user_factors[positions] @ self.item_factors.T
+
+    def set_user_factors(self, user_id, factors: np.ndarray):
+        """
+        Replaces a user's factors, adding the user to the model if they aren't in it yet
+        """
+        position = self.user_positions.get(user_id)
+        if position is None:
+            position = len(self.user_ids)
+            if position == len(self.__user_id_buffer):
+                # out of room, so double the buffers. Doubling keeps adding users O(1) on average
+                self.__user_id_buffer = np.resize(self.__user_id_buffer, max(2 * position, 1))
+                self.__user_factor_buffer = np.resize(self.__user_factor_buffer,
+                                                      (max(2 * position, 1), self.item_factors.shape[1]))
+            self.__user_id_buffer[position] = user_id
+            self.__user_factor_buffer[position] = factors
+            self.user_ids = self.__user_id_buffer[:position + 1]
+            self.user_factors = self.__user_factor_buffer[:position + 1]
+            # only make the user visible once their factors are in place
+            self.user_positions[user_id] = position
+        else:
+            self.user_factors[position] = factors
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+class FeedbackMatrix:
+    """
+    The users x items matrix of ratings, stored sparsely.
+    Only ratings that have actually been left are kept, as three parallel arrays sorted by user then item:
+    user_index and item_index (int32 row / column positions) and ratings (float32),
+    so memory scales with the number of ratings rather than users x items.
+    """
+
+    def __init__(self, ratings: pd.DataFrame):
+        """
+        @param ratings: feedback DataFrame with user_id, anime_id and rating columns
+        """
+        # ids are mapped to contiguous positions in sorted order, as pivot_table would do for its index / columns
+        self.user_ids, user_index = np.unique(ratings["user_id"].to_numpy(), return_inverse=True)
+        self.item_ids, item_index = np.unique(ratings["anime_id"].to_numpy(), return_inverse=True)
+        values = ratings["rating"].to_numpy(dtype=np.float32)
+
+        order = np.lexsort((item_index, user_index))
+        user_index, item_index, values = user_index[order], item_index[order], values[order]
+
+        # average out any user rating the same item more than once, like pivot_table(aggfunc=np.mean) does
+        firsts = np.flatnonzero(np.concatenate(([True], (np.diff(user_index) != 0) | (np.diff(item_index) != 0))))
+        if len(firsts) != len(values):
+            counts = np.diff(np.append(firsts, len(values)))
+            values = (np.add.reduceat(values, firsts) / counts).astype(np.float32)
+            user_index, item_index = user_index[firsts], item_index[firsts]
+
+        self.user_index: np.ndarray = user_index.astype(np.int32)
+        self.item_index: np.ndarray = item_index.astype(np.int32)
+        self.ratings: np.ndarray = values
+
+        # id <-> position lookups. position -> id is just self.user_ids[position]
+        self.user_positions: dict = {user_id: position for position, user_id in enumerate(self.user_ids.tolist())}
+        self.item_positions: dict = {item_id: position for position, item_id in enumerate(self.item_ids.tolist())}
+
+        # start of each user's ratings, as ratings are sorted by user. user u's are user_offsets[u]:user_offsets[u + 1]
+        self.user_offsets: np.ndarray = np.concatenate(
+            ([0], np.cumsum(np.bincount(self.user_index, minlength=len(self.user_ids))))).astype(np.int64)
+
+    @property
+    def shape(self) -> tuple:
+        return len(self.user_ids), len(self.item_ids)
+
+    def __len__(self):
+        """number of ratings stored"""
+        return len(self.ratings)
+
+    def get_user_ratings(self, user_id) -> tuple:
+        """
+        Finds the ratings a user has left without scanning the whole matrix
+        Returns: tuple of (item positions, ratings) for that user
+        """
+        position = self.user_positions[user_id]
+        start, end = self.user_offsets[position], self.user_offsets[position + 1]
+        return self.item_index[start:end], self.ratings[start:end]
+
+    def to_csr(self) -> csr_matrix:
+        """The same ratings as a scipy csr matrix, for anything that wants to do sparse linear algebra on them"""
+        return csr_matrix((self.ratings, self.item_index, self.user_offsets), shape=self.shape)
@@ -1,59 +1,216 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
 from typing import List, Tuple
 
+import numpy as np
 import pandas as pd
 
+from .dataset import Dataset
+from .rating_index import RatingIndex
 from .recommender import Recommender
 from ..exceptions import DataMatchError
+from ..utils import exclusion_mask, top_n_indices
 
 
 class HybridRecommender(Recommender):
     # combines the functionality of several different recommenders, instances of which are injected into this class
     # recommenders passed as (recommender instance, weighting) pairs.
-    def __init__(self, shows: pd.DataFrame, ratings: pd.DataFrame,
-                 recommenders: List[Tuple[Recommender, float]]) -> None:
-        super().__init__(shows, ratings)
+    def __init__(self, dataset: Dataset, recommenders: List[Tuple[Recommender, float]],
+                 rating_index: RatingIndex = None, executor: ThreadPoolExecutor = None, child_timeout: float = None,
+                 max_in_flight: int = None) -> None:
+        """
+        executor -- if given, each recommender is scored on it at the same time as the others, rather than one after
+        another. Recommenders spend their time in NumPy, which releases the GIL, so threads run them side by side.
+        It has to be threads rather than processes, as recommenders hold locks, which can't be pickled\n
+        child_timeout -- with an executor, the most seconds to wait for the recommenders to finish. Any that
+        haven't by then are left out, and the rest are fused without them\n
+        max_in_flight -- with an executor, the most scoring tasks to have on it at once, normally its number of
+        workers. Once that many are running, recommenders are left out rather than queued behind them\n
+        """
+        super().__init__(dataset, rating_index)
 
         for recommender, weighting in recommenders:
-            if not (recommender.shows.equals(shows) and recommender.ratings.equals(ratings)):
+            if not dataset.is_compatible(recommender.dataset):
                 raise DataMatchError("All recommenders must be trained on the passed "
                                      "items / feedback dataset to "
                                      "be used in conjunction in a hybrid recommender")
 
         self.recommenders = recommenders
+        self.executor = executor
+        self.child_timeout = child_timeout
+        # number of times a recommender has been left out for being too slow, or failing
+        self.degraded_count = 0
 
-    def generate_recommendations(self, user_id: int, recommendation_count: int = 10, verbose: bool = False,
-                                 items_to_ignore=None) -> pd.DataFrame:
-        if items_to_ignore is None:
-            items_to_ignore = []
-
-        joint_recs_df = pd.DataFrame(columns=["anime_id", "joint_score"])
-        # execute the recommendation algorithm of each recommender passed to this object
-        # and merge their results into one combined dataframe
-        for recommender, weighting in self.recommenders:
-            recs = recommender.generate_recommendations(user_id, -1, False, [])
+        # a task that timed out can't be stopped, and keeps one of the executor's workers until it finishes.
+        # a recommender is given no more tasks while it has any of these, so a slow one can't take over every worker
+        self.__abandoned_tasks = [0] * len(recommenders)
+        self.__in_flight = None if max_in_flight is None else threading.BoundedSemaphore(max_in_flight)
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __normalise_scores(scores: np.ndarray) -> np.ndarray:
+        """
+        Scales scores so the best is 10, so recommenders scoring on different scales can be added together.
+        Items with no score count as 0. For a users x items matrix, each user's row is scaled separately
+        """
+        best = np.where(np.isnan(scores), -np.inf, scores).max(axis=-1, initial=-np.inf, keepdims=True)
+        # a row with nothing to scale by has nothing to contribute
+        scaled = np.divide(10 * scores, best, out=np.zeros_like(scores, dtype=np.float64), where=best > 0)
+        return np.nan_to_num(scaled, nan=0.0)
+
+    def __fuse_scores(self, normalised_scores: list) -> np.ndarray:
+        # every recommender scores self.item_ids in the same order, so their scores can just be added up,
+        # each contributing in proportion to its recommenders weighting
+        joint_scores = np.zeros_like(normalised_scores[0])
+        for scores, (_, weighting) in zip(normalised_scores, self.recommenders):
+            joint_scores += weighting * scores
+        return joint_scores
+
+    def __score_children(self, user_id: int) -> tuple:
+        """
+        Every recommender's scores for the user, in the order of self.recommenders.
+        A recommender that didn't finish in time, or failed, gets all NaN scores, i.e. contributes nothing
+        Returns: tuple of (list of scores, whether any recommender was left out)
+        """
+        if self.executor is None:
+            return [recommender.score_items(user_id) for recommender, _ in self.recommenders], False
+
+        futures = [self.__submit(position, recommender, user_id)
+                   for position, (recommender, _) in enumerate(self.recommenders)]
+        # all the recommenders run at once, so this waits as long as the slowest of them, up to child_timeout
+        wait([future for future in futures if future is not None], timeout=self.child_timeout)
+        child_scores = []
+        degraded = False
+        for position, (future, (recommender, _)) in enumerate(zip(futures, self.recommenders)):
+            if future is None:
+                logging.warning(f"{type(recommender).__name__} is still busy with earlier requests, "
+                                f"fusing the other recommenders without it for user {user_id}")
+            elif future.done() and future.exception() is None:
+                child_scores.append(future.result())
+                continue
+            elif future.done():
+                logging.error(f"{type(recommender).__name__} failed for user {user_id}, "
+                              f"fusing the other recommenders without it", exc_info=future.exception())
+            else:
+                # it can't be stopped part way through, so the recommender gets no more tasks until it finishes
+                if not future.cancel():
+                    with self.__lock:
+                        self.__abandoned_tasks[position] += 1
+                    future.add_done_callback(partial(self.__abandoned_task_done, position))
+                logging.warning(f"{type(recommender).__name__} took longer than {self.child_timeout}s "
+                                f"for user {user_id}, fusing the other recommenders without it")
+            with self.__lock:
+                self.degraded_count += 1
+            degraded = True
+            child_scores.append(np.full(len(self.item_ids), np.nan))
+        return child_scores, degraded
+
+    def __submit(self, position: int, recommender: Recommender, user_id: int):
+        """
+        Starts scoring the user with the recommender on the executor
+        Returns: the task's future, or None if the recommender is to be left out rather than given another task
+        """
+        with self.__lock:
+            if self.__abandoned_tasks[position]:
+                return None
+        if self.__in_flight is not None and not self.__in_flight.acquire(blocking=False):
+            return None
+        try:
+            future = self.executor.submit(recommender.score_items, user_id)
+        except BaseException:
+            if self.__in_flight is not None:
+                self.__in_flight.release()
+            raise
+        if self.__in_flight is not None:
+            future.add_done_callback(lambda _: self.__in_flight.release())
+        return future
+
+    def __abandoned_task_done(self, position: int, _future):
+        with self.__lock:
+            self.__abandoned_tasks[position] -= 1
+
+    def __recommendations_frame(self, child_scores: list, normalised_scores: list, joint_scores: np.ndarray,
+                                recommendation_count: int, items_to_ignore) -> pd.DataFrame:
+        """The top recommendations of one user from their scores, along with what each recommender made of them"""
+        # filter out items_to_ignore and pick the best of what's left
+        ignored = exclusion_mask(self.item_positions, len(joint_scores), items_to_ignore)
+        top = top_n_indices(joint_scores, recommendation_count, ignored)
+        top_shows = pd.DataFrame({"anime_id": self.item_ids[top], "joint_score": joint_scores[top]})
+        for (recommender, _), scores, normalised in zip(self.recommenders, child_scores, normalised_scores):
             score_column = recommender.get_score_column_name()
-            recs[score_column + "_normalized"] = 10 * (recs[score_column] / max(recs[score_column]))
+            top_shows[score_column] = np.nan_to_num(scores[top], nan=0.0)
+            top_shows[score_column + "_normalized"] = normalised[top]
+        return top_shows
+
+    def score_items(self, user_id: int) -> np.ndarray:
+        child_scores, _ = self.__score_children(user_id)
+        return self.__fuse_scores([self.__normalise_scores(scores) for scores in child_scores])
 
-            joint_recs_df = pd.merge(left=joint_recs_df, right=recs, how='outer', left_on='anime_id',
-                                     right_on='anime_id').fillna(0.0)
-            # contribute to each shows score in proportion to this recommenders weighting
-            joint_recs_df['joint_score'] += recs[score_column + "_normalized"] * weighting
+    def score_items_batch(self, user_ids) -> np.ndarray:
+        # recommenders are scored one after another here, each batch is already a big matrix product
+        # that makes use of every core, and there's no request waiting on it to time out
+        return self.__fuse_scores([self.__normalise_scores(recommender.score_items_batch(user_ids))
+                                   for recommender, _ in self.recommenders])
 
-        # filter...
-        filtered_recs = joint_recs_df.filter(items=(set(joint_recs_df.index) - set(items_to_ignore)), axis=0)
-        # and then sort
-        top_shows = filtered_recs.sort_values(by='joint_score', ascending=False)[
-                    :min(recommendation_count, len(joint_recs_df))]
+    def generate_recommendations(self, user_id: int, recommendation_count: int = 10, verbose: bool = False,
+                                 items_to_ignore=None) -> pd.DataFrame:
+        """
+        As for Recommender.generate_recommendations, with each recommender's score and normalised score alongside
+        the joint score. If any recommender was left out, the DataFrame's attrs["degraded"] is True
+        """
+        child_scores, degraded = self.__score_children(user_id)
+        normalised_scores = [self.__normalise_scores(scores) for scores in child_scores]
+        joint_scores = self.__fuse_scores(normalised_scores)
+        top_shows = self.__recommendations_frame(child_scores, normalised_scores, joint_scores, recommendation_count,
+                                                 items_to_ignore)
 
         if verbose:
             top_shows = top_shows.merge(
                 self.shows, how='left', left_on="anime_id", right_on="anime_id")
 
+        top_shows.attrs["degraded"] = degraded
         return top_shows
 
+    def generate_recommendation_frames(self, user_ids, recommendation_count: int = 10, exclude_rated: bool = True,
+                                       batch_size: int = 1024) -> list:
+        # each recommender's own scores go in the frames too, so this is built on the children's batch scores
+        # rather than on generate_recommendations_batch
+        user_ids = np.asarray(user_ids)
+        known = self.known_users(user_ids)
+        frames = []
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            batch_known = known[start:start + batch_size]
+            # as in generate_recommendations_batch, users with no ratings get no recommendations
+            child_scores = [self.__scores_of_known(recommender, batch, batch_known)
+                            for recommender, _ in self.recommenders]
+            normalised_scores = [self.__normalise_scores(scores) for scores in child_scores]
+            joint_scores = self.__fuse_scores(normalised_scores)
+            for row, user_id in enumerate(batch.tolist()):
+                items_to_ignore = self.rating_index.get_user_ratings(user_id)[0] if exclude_rated else None
+                frames.append(self.__recommendations_frame([scores[row] for scores in child_scores],
+                                                           [scores[row] for scores in normalised_scores],
+                                                           joint_scores[row],
+                                                           recommendation_count if batch_known[row] else 0,
+                                                           items_to_ignore))
+        return frames
+
+    def __scores_of_known(self, recommender, user_ids: np.ndarray, known: np.ndarray) -> np.ndarray:
+        """recommender.score_items_batch of just the known users, NaN rows for the rest"""
+        scores = np.full((len(user_ids), len(self.item_ids)), np.nan)
+        if known.any():
+            scores[known] = recommender.score_items_batch(user_ids[known])
+        return scores
+
     def refresh(self):
         for recommender, _ in self.recommenders:
             recommender.refresh()
 
+    def update_user(self, user_id: int, user_ratings: pd.DataFrame):
+        for recommender, _ in self.recommenders:
+            recommender.update_user(user_id, user_ratings)
+
     def get_score_column_name(self) -> str:
         return "joint_score"
@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from src.recommenders.collaborative_recommender import CollabRecommender
+from src.recommenders.content_recommender import ContentRecommender
+from src.recommenders.factor_model import FactorModel
+
+# bump this whenever the files written by save_snapshot change, so old snapshots are ignored rather than misread
+SNAPSHOT_FORMAT_VERSION = 3
+
+
+# Trained state is saved as plain .npy arrays, one directory per save, named by when it was saved:
+#
+#   <directory>/<saved at>/manifest.json    format version, rating watermark and training metadata
+#   <directory>/<saved at>/collab_*.npy     user / item ids and factors of the collaborative model
+#   <directory>/<saved at>/content_*.npy    genre frequencies and the show genre / embedding matrices
+#
+# so that on startup the newest can be memory mapped straight back in instead of retraining.
+# The watermark is the latest rating update the model has taken in, so only the ratings changed since then
+# have to be folded in on top of it.
+
+
+def _snapshot_names(directory) -> list:
+    """names of the saved snapshots in directory, newest first"""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted((name for name in names if name.isdigit()), key=int, reverse=True)
+
+
+def _save_csr(directory, name, matrix: csr_matrix):
+    for part in ("data", "indices", "indptr"):
+        np.save(os.path.join(directory, f"{name}_{part}.npy"), getattr(matrix, part))
+
+
+def _load_csr(directory, name, shape, mmap_mode) -> csr_matrix:
+    data, indices, indptr = (np.load(os.path.join(directory, f"{name}_{part}.npy"), mmap_mode=mmap_mode)
+                             for part in ("data", "indices", "indptr"))
+    return csr_matrix((data, indices, indptr), shape=shape)
+
+
+def save_snapshot(directory: str, watermark, content_r: ContentRecommender, collab_r: CollabRecommender,
+                  keep: int = 3):
+    """
+    Saves the trained state of the content and collaborative recommenders, then deletes all but the newest keep
+    snapshots.
+    Everything is written to a temporary directory first and moved into place at the end,
+    so a crash part way through never leaves a half written snapshot behind.
+    @param watermark: naive UTC datetime of the latest rating update the collaborative model has taken in,
+    None if there were no ratings. Read it before the model, so nothing later is taken to be in it
+    """
+    saved_at = time.time()
+    # the newest snapshot always sorts first, even if the clock is wound back between saves
+    previous = _snapshot_names(directory)
+    snapshot_path = os.path.join(directory, str(max(int(saved_at * 1000), int(previous[0]) + 1 if previous else 0)))
+    temporary_path = snapshot_path + ".tmp"
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+
+    model = collab_r.model
+    np.save(os.path.join(temporary_path, "collab_user_ids.npy"), model.user_ids)
+    np.save(os.path.join(temporary_path, "collab_item_ids.npy"), model.item_ids)
+    np.save(os.path.join(temporary_path, "collab_user_factors.npy"), model.user_factors)
+    np.save(os.path.join(temporary_path, "collab_item_factors.npy"), model.item_factors)
+
+    np.save(os.path.join(temporary_path, "content_genres.npy"), np.array(content_r.genres, dtype=str))
+    np.save(os.path.join(temporary_path, "content_genre_frequencies.npy"), content_r.genre_frequency_vector)
+    np.save(os.path.join(temporary_path, "content_show_ids.npy"), content_r.item_ids)
+    _save_csr(temporary_path, "content_show_genres", content_r.show_genres)
+    _save_csr(temporary_path, "content_show_embeddings", content_r.show_embeddings)
+
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "watermark": None if watermark is None else pd.Timestamp(watermark).isoformat(),
+        "saved_at": saved_at,
+        "collab_trained_at": model.trained_at,
+        "collab_training_seconds": model.training_seconds,
+        "collab_training_curve": model.training_curve,
+        "collab_global_mean": model.global_mean,
+    }
+    with open(os.path.join(temporary_path, "manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    os.rename(temporary_path, snapshot_path)
+    logging.info(f"Saved model snapshot to {snapshot_path}")
+
+    for old_name in _snapshot_names(directory)[keep:]:
+        shutil.rmtree(os.path.join(directory, old_name), ignore_errors=True)
+
+
+def load_latest_snapshot(directory: str, item_ids: np.ndarray) -> Optional[dict]:
+    """
+    Loads the newest snapshot in the current format.
+    Arrays are memory mapped rather than read in. User factors are mapped copy-on-write,
+    as folding in new ratings writes to them, everything else is read only.
+    @param item_ids: the shows being recommended from. The content recommender's state is only for the shows it
+    was saved with, so if those have changed it's left out, to be worked out again
+
+    Returns: None if there's no usable snapshot, otherwise a dictionary of
+        "watermark": the latest rating update the model has taken in, as a naive UTC datetime, or None,
+        "collab_model": FactorModel for CollabRecommender's model argument,
+        "content": keyword arguments for ContentRecommender, None if the shows have changed
+    """
+    for name in _snapshot_names(directory):
+        snapshot = _load_snapshot(os.path.join(directory, name), item_ids)
+        if snapshot is not None:
+            return snapshot
+    return None
+
+
+def _load_snapshot(snapshot_path: str, item_ids: np.ndarray) -> Optional[dict]:
+    try:
+        with open(os.path.join(snapshot_path, "manifest.json")) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        return None
+
+    def load(name, mmap_mode="r"):
+        return np.load(os.path.join(snapshot_path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+    model = FactorModel(load("collab_user_ids"), load("collab_item_ids"),
+                        load("collab_user_factors", mmap_mode="c"), load("collab_item_factors"),
+                        global_mean=manifest["collab_global_mean"])
+    model.trained_at = manifest["collab_trained_at"]
+    model.training_seconds = manifest["collab_training_seconds"]
+    model.training_curve = manifest.get("collab_training_curve")
+
+    content = None
+    show_ids = load("content_show_ids")
+    if np.array_equal(show_ids, item_ids):
+        genres = load("content_genres", mmap_mode=None).tolist()
+        frequencies = load("content_genre_frequencies")
+        shape = (len(show_ids), len(genres))
+        content = {
+            "genre_frequencies": {genre: int(frequency) for genre, frequency in zip(genres, frequencies)},
+            "show_genres": _load_csr(snapshot_path, "content_show_genres", shape, "r"),
+            "show_embeddings": _load_csr(snapshot_path, "content_show_embeddings", shape, "r"),
+        }
+    watermark = manifest["watermark"]
+    logging.info(f"Loaded model snapshot from {snapshot_path}")
+    return {"watermark": None if watermark is None else pd.Timestamp(watermark), "collab_model": model,
+            "content": content}
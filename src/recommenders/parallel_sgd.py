@@ -0,0 +1,114 @@
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# DSGD (distributed stochastic gradient descent) over a pool of worker processes.
+# Users and items are each split into as many blocks as there are workers, which splits the ratings into a
+# workers x workers grid. Each epoch is run as workers sub-epochs, and in each sub-epoch every worker trains on
+# a different cell of the grid, chosen so no two of them share a user block or an item block.
+# Workers then never write to the same factor rows at the same time, so they can all update the same
+# shared memory factor arrays in place without any locking, and the result doesn't depend on which worker
+# happens to finish first.
+
+# the arrays shared with each worker process, attached to once when the process starts, by name
+_worker_arrays = {}
+_worker_memory = []
+
+
+def _attach_worker(specs):
+    """Pool initializer, maps every shared array into this worker process"""
+    for name, (memory_name, shape, dtype) in specs.items():
+        memory = shared_memory.SharedMemory(name=memory_name)
+        _worker_memory.append(memory)
+        _worker_arrays[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+def _train_block(task):
+    """Runs one epoch of solver over the ratings from start to end, in this worker's shared arrays"""
+    # imported here rather than at the top, as prediction_algorithms imports this module
+    from src.recommenders.prediction_algorithms import minibatch_sgd_epoch, sgd_epoch
+
+    start, end, solver, alpha, gamma, batch_size, seed, user_trainable, item_trainable = task
+    arrays = _worker_arrays
+    users, items, ratings = arrays["users"][start:end], arrays["items"][start:end], arrays["ratings"][start:end]
+    if solver == "sgd":
+        order = np.random.default_rng(seed).permutation(end - start)
+        sgd_epoch(arrays["user_lfs"], arrays["item_lfs"], users[order], items[order], ratings[order], alpha, gamma,
+                  user_trainable, item_trainable)
+    else:
+        minibatch_sgd_epoch(arrays["user_lfs"], arrays["item_lfs"], users, items, ratings, alpha, gamma, batch_size,
+                            np.random.default_rng(seed), user_trainable, item_trainable)
+
+
+class ParallelSGD:
+    """
+    Trains factors with DSGD on workers processes, see the top of this module.
+    The factors and ratings are copied into shared memory once, and user_lfs / item_lfs are views of it,
+    so after each epoch they already hold the updated factors. close must be called once training is done,
+    and user_lfs / item_lfs copied first if they're still needed.
+    """
+
+    def __init__(self, user_lfs: np.ndarray, item_lfs: np.ndarray, users, items, ratings, workers: int, rng):
+        """
+        @param user_lfs: users x latent_feature_count starting factors
+        @param item_lfs: items x latent_feature_count starting factors
+        @param users: index of the user who left each rating
+        @param items: index of the item each rating is for
+        @param ratings: the ratings themselves
+        @param workers: number of worker processes, and of user / item blocks
+        @param rng: numpy Generator the blocks and each worker's randomness are drawn from
+        """
+        self.workers = workers
+        self.rng = rng
+
+        # each user and item is put in a random block, which spreads the ratings fairly evenly between blocks
+        user_blocks = rng.permutation(len(user_lfs)) % workers
+        item_blocks = rng.permutation(len(item_lfs)) % workers
+        grid_cells = user_blocks[users] * workers + item_blocks[items]
+        # ratings are sorted by grid cell, so each cell is one contiguous slice of them
+        order = np.argsort(grid_cells, kind="stable")
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(grid_cells, minlength=workers * workers))))
+
+        self.__memory = []
+        specs = {}
+        shared = {}
+        for name, array in (("user_lfs", user_lfs), ("item_lfs", item_lfs), ("users", users[order]),
+                            ("items", items[order]), ("ratings", ratings[order])):
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self.__memory.append(memory)
+            shared[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+            shared[name][:] = array
+            specs[name] = (memory.name, array.shape, array.dtype)
+        self.user_lfs, self.item_lfs = shared["user_lfs"], shared["item_lfs"]
+
+        self.__pool = multiprocessing.Pool(workers, initializer=_attach_worker, initargs=(specs,))
+
+    def epoch(self, solver, alpha, gamma, batch_size, user_trainable=1, item_trainable=1):
+        """
+        One epoch of solver, 'sgd' or 'minibatch', over every rating.
+        user_trainable / item_trainable are as for sgd_epoch
+        """
+        workers = self.workers
+        # a block holds 1 / workers of its users' and items' ratings, but only 1 / workers ** 2 of all ratings,
+        # so its batches are made workers times smaller to keep each user / item's share of a batch the same
+        batch_size = max(batch_size // workers, 1)
+        for shift in self.rng.permutation(workers):
+            # worker w takes the cell of user block w and item block w + shift, so no two share a block
+            cells = [w * workers + (w + shift) % workers for w in range(workers)]
+            seeds = self.rng.integers(2 ** 32, size=workers)
+            tasks = [(self.offsets[cell], self.offsets[cell + 1], solver, alpha, gamma, batch_size, seed,
+                      user_trainable, item_trainable)
+                     for cell, seed in zip(cells, seeds)]
+            # every cell has to finish before the next sub-epoch moves the workers onto blocks others just had
+            self.__pool.map(_train_block, tasks)
+
+    def close(self):
+        """Stops the workers and frees the shared memory, after which user_lfs and item_lfs can't be used"""
+        self.__pool.close()
+        self.__pool.join()
+        self.user_lfs = self.item_lfs = None
+        for memory in self.__memory:
+            memory.close()
+            memory.unlink()
+        self.__memory = []
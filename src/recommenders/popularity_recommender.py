@@ -1,18 +1,67 @@
-from src.utils import calculate_popularity_stats, weight_rating
+import numpy as np
 import pandas as pd
 
+from src.utils import calculate_popularity_stats, weight_rating
+
 
 class PopularityRecommender:
+    """
+    Recommends the same shows to everyone, ranked by IMDB weighted rating.
+    Scores only depend on the shows, so they're worked out once, for every show at the same time,
+    and kept ranked. A request is then just a slice off the top of the ranking.
+    Filtering by genre uses an inverted index from each genre to the ranks of the shows in it,
+    so it never has to look at shows outside those genres.
+    """
 
-    def generate_recommendations(self, shows: pd.DataFrame, recommendation_count: int = 10, verbose: bool = False) -> pd.DataFrame:
+    def __init__(self, shows: pd.DataFrame):
+        self.refresh(shows)
 
+    def refresh(self, shows: pd.DataFrame):
+        """
+        Re-ranks every show, to be called whenever the anime table changes
+        """
+        self.shows = shows
         overall_vote_average, member_minimum = calculate_popularity_stats(shows)
-        filtered_recs = shows[shows['members'] >= member_minimum]
-        filtered_recs['weighted_score'] = filtered_recs.apply(
-            func=lambda show: weight_rating(show, member_minimum, overall_vote_average), axis=1)
-        top_shows = filtered_recs.sort_values(by='weighted_score',
-                                              ascending=False)[
-                    :min(recommendation_count, len(filtered_recs))]
+        # only shows with enough members to be trusted are ranked at all
+        eligible_shows = shows[shows['members'] >= member_minimum]
+        # weight_rating is plain arithmetic on its columns, so it scores the whole DataFrame in one go
+        weighted_scores = weight_rating(eligible_shows, member_minimum, overall_vote_average).to_numpy()
+        ranking = np.argsort(-weighted_scores, kind="stable")
+
+        self.ranked_shows: pd.DataFrame = eligible_shows.iloc[ranking].assign(weighted_score=weighted_scores[ranking])
+        self.ranked_shows.reset_index(drop=True, inplace=True)
+
+        # lower case genre: ascending array of the ranks of every show with that genre, i.e. most popular first
+        genres = self.ranked_shows['genre'].str.lower().str.split(', ').explode()
+        self.genre_postings: dict = {genre: ranks.to_numpy() for genre, ranks in
+                                     genres.index.to_series().groupby(genres.to_numpy())}
+
+    def find_genre_ranks(self, genres) -> np.ndarray:
+        """
+        Ranks of every show with any of genres, most popular first
+        :param genres: genre names, in any case. Unknown genres match nothing
+        """
+        postings = [self.genre_postings.get(genre.strip().lower()) for genre in genres]
+        postings = [ranks for ranks in postings if ranks is not None]
+        if not postings:
+            return np.empty(0, dtype=np.int64)
+        # union of already sorted rank arrays, which comes out sorted too, so still most popular first
+        return postings[0] if len(postings) == 1 else np.unique(np.concatenate(postings))
+
+    def generate_recommendations(self, recommendation_count: int = 10, verbose: bool = False,
+                                 genres=None) -> pd.DataFrame:
+        """
+        The most popular shows, most popular first
+
+        :param recommendation_count: the number of recommendations you want. -1 gives every ranked show
+        :param verbose: if False only anime ids and scores are returned, if True, the entire show is
+        :param genres: if given, only shows with at least one of these genres are recommended
+        """
+        end = None if recommendation_count < 0 else recommendation_count
+        if genres is None:
+            top_shows = self.ranked_shows.iloc[:end]
+        else:
+            top_shows = self.ranked_shows.iloc[self.find_genre_ranks(genres)[:end]]
 
         if not verbose:
             top_shows = top_shows[["anime_id", "weighted_score"]]
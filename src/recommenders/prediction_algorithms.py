@@ -1,11 +1,12 @@
-import functools
-import operator
-
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
 
 from src.myconstants import PROD
-from src.utils import calc_mean_squared_error
+from src.recommenders.factor_model import FactorModel
+from src.recommenders.feedback_matrix import FeedbackMatrix
+from src.recommenders.parallel_sgd import ParallelSGD
+from src.utils import calc_mean_squared_error, truncated_svd
 
 
 def calc_validity_stats(predictions, actual_data):
@@ -33,12 +34,313 @@ def on_epoch_start(epoch_num):
     print(f"Epoch: {epoch_num + 1}")
 
 
-def calc_sgd_predictions(feedback_df: pd.DataFrame, *, max_epoch_count=1000, latent_feature_count=75, alpha=0.01,
-                         gamma=0.4,
-                         accepted_deviation=2.5) -> pd.DataFrame:
-    """Calculates prediction matrix by using matrix factorisation and stochastic gradient descent
+SGD_SOLVERS = ("sgd", "minibatch", "als")
+# every solver calc_sgd_model accepts, 'svd' being a truncated SVD rather than a trained factorisation
+FACTORISATION_SOLVERS = SGD_SOLVERS + ("svd",)
+
+
+def calc_observed_mse(user_lfs, item_lfs, users, items, ratings):
+    """
+    Calculates the mean squared error of a factorisation over only the ratings that have actually been left.
+    Each prediction is gathered as a dot product of the relevant factor rows,
+    so the full users x items prediction matrix never has to be built.
+    Parameters
+    ------------
+    user_lfs:
+        users x latent_feature_count matrix of user factors
+    item_lfs:
+        items x latent_feature_count matrix of item factors
+    users, items:
+        index arrays of the user / item each rating belongs to
+    ratings:
+        the rating values themselves
+    Returns
+    ---------
+    mean squared error over the given ratings
+    """
+    predictions = np.einsum("ij,ij->i", user_lfs[users], item_lfs[items])
+    return np.mean((ratings - predictions) ** 2)
+
+
+def group_by_index(index):
+    """
+    Groups positions of an index array by the value at that position.
+    Returns
+    ---------
+    tuple of (order, values, starts, ends) where order[starts[j]:ends[j]] are the positions holding values[j]
+    """
+    order = np.argsort(index, kind="stable")
+    sorted_index = index[order]
+    boundaries = np.flatnonzero(np.diff(sorted_index)) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(index)]))
+    return order, sorted_index[starts], starts, ends
+
+
+def scatter_mean_add(factors, index, steps):
+    """
+    Adds the rows of steps onto the rows of factors given by index.
+    Rows hit more than once in the same batch receive the mean of their steps, not the sum,
+    so a user with many ratings in one batch doesn't take one enormous step.
+    """
+    order, rows, starts, ends = group_by_index(index)
+    summed_steps = np.add.reduceat(steps[order], starts, axis=0)
+    factors[rows] += summed_steps / (ends - starts)[:, np.newaxis]
+
+
+def sgd_epoch(user_lfs, item_lfs, users, items, ratings, alpha, gamma, user_trainable=1, item_trainable=1):
+    """
+    One epoch of the original one-rating-at-a-time stochastic gradient descent. Kept as the reference solver.
+    user_trainable / item_trainable are 1, or an array with a 1 for each factor column that's trained and a 0 for
+    each that's held fixed, which every step is multiplied by. The biased model holds its constant columns fixed
+    """
+    for u, i, rating in zip(users, items, ratings):
+        dot = np.dot(user_lfs[u], item_lfs[i])
+        difference = rating - dot
+        user_lfs[u] += 2 * alpha * (difference * item_lfs[i] - gamma * user_lfs[u]) * user_trainable
+        item_lfs[i] += 2 * alpha * (difference * user_lfs[u] - gamma * item_lfs[i]) * item_trainable
+
+
+def minibatch_sgd_epoch(user_lfs, item_lfs, users, items, ratings, alpha, gamma, batch_size, rng=np.random,
+                        user_trainable=1, item_trainable=1):
+    """
+    One epoch of mini-batch gradient descent.
+    Ratings are visited in a random order, batch_size at a time, with every update in a batch
+    calculated at once from the factors as they were at the start of that batch.
+    user_trainable / item_trainable are as for sgd_epoch
+    """
+    order = rng.permutation(len(ratings))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        batch_users, batch_items = users[batch], items[batch]
+        batch_user_lfs = user_lfs[batch_users]
+        batch_item_lfs = item_lfs[batch_items]
+
+        difference = (ratings[batch] - np.einsum("ij,ij->i", batch_user_lfs, batch_item_lfs))[:, np.newaxis]
+        user_steps = 2 * alpha * (difference * batch_item_lfs - gamma * batch_user_lfs) * user_trainable
+        item_steps = 2 * alpha * (difference * batch_user_lfs - gamma * batch_item_lfs) * item_trainable
+
+        scatter_mean_add(user_lfs, batch_users, user_steps)
+        scatter_mean_add(item_lfs, batch_items, item_steps)
+
+
+def solve_factor_row(fixed, ratings, gamma):
+    """
+    Finds the factors of one user (or item) exactly, given the fixed factors of everything it rated (or was rated by).
+    This is the regularised least squares fit to its ratings, with the regularisation scaled by the rating count
+    so that it minimises the same loss as gradient descent.
+    Parameters
+    ------------
+    fixed:
+        rating count x latent_feature_count matrix, the factors of the other side of each rating
+    ratings:
+        the ratings themselves
+    gamma:
+        regularization parameter
+    """
+    identity = np.identity(fixed.shape[1])
+    return np.linalg.solve(fixed.T @ fixed + gamma * len(ratings) * identity, fixed.T @ ratings)
+
+
+def solve_als_factors(solved_lfs, fixed_lfs, groups, fixed_index, ratings, gamma):
+    """
+    Solves for every row of solved_lfs exactly with solve_factor_row, holding fixed_lfs constant.
+    """
+    order, solved_rows, starts, ends = groups
+    for row, start, end in zip(solved_rows, starts, ends):
+        rating_rows = order[start:end]
+        solved_lfs[row] = solve_factor_row(fixed_lfs[fixed_index[rating_rows]], ratings[rating_rows], gamma)
+
+
+def als_epoch(user_lfs, item_lfs, user_groups, item_groups, users, items, ratings, gamma):
+    """One epoch of alternating least squares: solve every user with items fixed, then every item with users fixed"""
+    solve_als_factors(user_lfs, item_lfs, user_groups, items, ratings, gamma)
+    solve_als_factors(item_lfs, user_lfs, item_groups, users, ratings, gamma)
+
+
+def split_validation(users, ratings_count, validation_fraction, rng=np.random):
+    """
+    Randomly picks roughly validation_fraction of the ratings to validate training against.
+    Every user's first rating is always kept for training, so no user is left with nothing to be trained on.
+    Returns
+    ---------
+    boolean array, True for each rating held out for validation
+    """
+    held_out = rng.random(ratings_count) < validation_fraction
+    held_out[np.unique(users, return_index=True)[1]] = False
+    return held_out
 
-    :param feedback_df: pd.Dataframe the sparse user / item matrix to predict
+
+def calc_latent_factors(users, items, ratings, shape, *, max_epoch_count=1000, latent_feature_count=75, alpha=0.01,
+                        gamma=0.4, accepted_deviation=2.5, solver="minibatch", batch_size=1024,
+                        validation_fraction=0.1, patience=3, min_improvement=1e-4, min_epoch_count=10,
+                        error_sample_size=10_000, biased=False, dtype=np.float64, seed=None, workers=1):
+    """Factorises a set of ratings into user and item latent factors.
+    validation_fraction of the ratings are held out of training, and the error on them is measured after every epoch.
+    Training stops once that error hasn't improved for patience epochs in a row.
+    With early stopping on, the factors from the epoch with the lowest error are the ones returned,
+    whichever way training ends. Without it they're the factors from the last epoch.
+
+    :param users: np.ndarray index of the user who left each rating
+    :param items: np.ndarray index of the item each rating is for
+    :param ratings: np.ndarray the ratings themselves
+    :param shape: (user count, item count) of the full feedback matrix
+    :param solver: str one of SGD_SOLVERS.
+        'sgd' is the original loop over one rating at a time,
+        'minibatch' does the same updates for batch_size ratings at once with numpy,
+        'als' is alternating least squares, which ignores alpha and batch_size.
+    :param batch_size: int number of ratings per 'minibatch' update
+    :param validation_fraction: float fraction of ratings to validate against rather than train on.
+        If 0, the error on the training ratings is what decides when to stop
+    :param patience: int number of epochs without improvement to allow before stopping. None never stops early
+    :param min_improvement: float how much lower than the best error so far an epoch's error must be to count
+        as an improvement
+    :param min_epoch_count: int number of epochs always run before training can stop, early or on
+        accepted_deviation. The error often barely moves, or even rises, over the first few epochs while the
+        factors are still tiny, which would otherwise look like training having stopped improving.
+        That takes a number of updates rather than epochs, so small sets of ratings, with few batches per epoch,
+        need more of these
+    :param error_sample_size: int the training error is measured on a fixed random sample of this many ratings,
+        rather than all of them
+    :param biased: bool whether to learn a global mean, user biases and item biases alongside the factors.
+        The latent features then only have to fit how ratings differ from those, so far fewer of them, and far fewer
+        epochs, are needed. The biases are stored as two extra factor columns, see FactorModel.
+        Only the gradient descent solvers support this
+    :param dtype: the float type to train and store the factors in. float32 halves their memory
+    :param seed: int seed for every random choice made in training, so the same seed gives the same factors.
+        None uses the global numpy random state
+    :param workers: int number of processes to train the 'sgd' or 'minibatch' solver on, see ParallelSGD.
+        1 trains in this process
+    Every other parameter is as for calc_sgd_model.
+    :return tuple of (user factors, item factors, error curve). The factors have one row per user / item and
+        one column per latent feature. The error curve is a list with a dictionary of epoch, train_mse and
+        validation_mse for every epoch that was run
+    """
+
+    if solver not in SGD_SOLVERS:
+        raise ValueError(f"solver must be one of {SGD_SOLVERS}, not {solver}")
+    if biased and solver == "als":
+        raise ValueError("biased factors can only be trained by the 'sgd' and 'minibatch' solvers")
+    if max_epoch_count <= 0:
+        max_epoch_count = 1000
+
+    rng = np.random if seed is None else np.random.default_rng(seed)
+    ratings = ratings.astype(dtype)
+    m, n = shape
+    if biased:
+        # the factors are trained on how far each rating is from the mean rating, starting from zero biases.
+        # small starting factors leave the biases to fit the ratings first, and min_epoch_count keeps early
+        # stopping from ending training while the factors are still growing out of that
+        global_mean = ratings.mean(dtype=np.float64)
+        ratings = ratings - ratings.dtype.type(global_mean)
+        user_lfs = np.hstack((0.1 * rng.standard_normal((m, latent_feature_count)),
+                              np.zeros((m, 1)), np.ones((m, 1)))).astype(dtype)
+        item_lfs = np.hstack((0.1 * rng.standard_normal((n, latent_feature_count)),
+                              np.ones((n, 1)), np.zeros((n, 1)))).astype(dtype)
+        # the columns the biases are multiplied by stay at exactly 1, so gradient descent never steps them
+        user_trainable = np.ones(latent_feature_count + 2, dtype=dtype)
+        user_trainable[-1] = 0
+        item_trainable = np.ones(latent_feature_count + 2, dtype=dtype)
+        item_trainable[-2] = 0
+    else:
+        user_lfs = rng.random((m, latent_feature_count)).astype(dtype)
+        item_lfs = rng.random((n, latent_feature_count)).astype(dtype)
+        user_trainable = item_trainable = 1
+
+    validation = None
+    if validation_fraction > 0:
+        validation = split_validation(users, len(ratings), validation_fraction, rng)
+    if validation is not None and validation.any():
+        validation_users, validation_items = users[validation], items[validation]
+        validation_ratings = ratings[validation]
+        users, items, ratings = users[~validation], items[~validation], ratings[~validation]
+    else:
+        validation = None
+    # error is only ever measured as dot products of the sampled ratings' factor rows, never the full product
+    error_sample = rng.choice(len(ratings), size=min(error_sample_size, len(ratings)), replace=False)
+    sample_users, sample_items, sample_ratings = users[error_sample], items[error_sample], ratings[error_sample]
+
+    if solver == "als":
+        # which ratings belong to which user / item never changes, so only work it out once
+        user_groups = group_by_index(users)
+        item_groups = group_by_index(items)
+
+    parallel = None
+    if workers > 1 and solver != "als":
+        parallel = ParallelSGD(user_lfs, item_lfs, users, items, ratings, workers,
+                               rng if seed is not None else np.random.default_rng(np.random.randint(2 ** 31)))
+        # from here on the factors are the ones the workers update, in shared memory
+        user_lfs, item_lfs = parallel.user_lfs, parallel.item_lfs
+
+    try:
+        curve = []
+        best_mse, best_epoch, best_lfs = np.inf, -1, None
+        for epoch in range(max_epoch_count):  # iterate gradient descent
+            if not PROD:
+                on_epoch_start(epoch)  # development logging stuff
+
+            # iterate again and improve our approximation
+            if parallel is not None:
+                parallel.epoch(solver, alpha, gamma, batch_size, user_trainable, item_trainable)
+            elif solver == "sgd":
+                sgd_epoch(user_lfs, item_lfs, users, items, ratings, alpha, gamma, user_trainable, item_trainable)
+            elif solver == "minibatch":
+                minibatch_sgd_epoch(user_lfs, item_lfs, users, items, ratings, alpha, gamma, batch_size, rng,
+                                    user_trainable, item_trainable)
+            else:
+                als_epoch(user_lfs, item_lfs, user_groups, item_groups, users, items, ratings, gamma)
+
+            # check how good the approximation is, judged by the ratings it wasn't trained on if there are any
+            train_mse = calc_observed_mse(user_lfs, item_lfs, sample_users, sample_items, sample_ratings)
+            validation_mse = None
+            if validation is not None:
+                validation_mse = calc_observed_mse(user_lfs, item_lfs, validation_users, validation_items,
+                                                   validation_ratings)
+            curve.append({"epoch": epoch + 1, "train_mse": float(train_mse),
+                          "validation_mse": None if validation_mse is None else float(validation_mse)})
+            mse = train_mse if validation_mse is None else validation_mse
+            if not PROD:
+                print("MSE:", train_mse, "validation MSE:", validation_mse)
+
+            if mse < best_mse - min_improvement:
+                best_mse, best_epoch = mse, epoch
+                if patience is not None:
+                    best_lfs = (user_lfs.copy(), item_lfs.copy())
+            if epoch + 1 < min_epoch_count:
+                continue
+            if patience is not None and epoch - best_epoch >= patience:
+                # the error has stopped improving, so carrying on would only fit the training ratings more closely
+                print(f"stopped early after {epoch + 1} epochs, the best being epoch {best_epoch + 1}")
+                break
+
+            # check if the approximation is 'good enough'
+            if mse < accepted_deviation:
+                print(f"broke after {epoch + 1} epochs")
+                break
+
+        if best_lfs is not None and best_epoch != len(curve) - 1:
+            # however training ended, the epoch with the lowest error is the one kept
+            user_lfs, item_lfs = best_lfs
+    finally:
+        if parallel is not None:
+            # copied out of the shared memory before it's freed
+            user_lfs, item_lfs = user_lfs.copy(), item_lfs.copy()
+            parallel.close()
+
+    if biased:
+        # the factors were fitted to ratings less the mean, so fold the mean back into every user's bias.
+        # then the plain dot product of a user and item is their predicted rating, just as it is without biases
+        user_lfs[:, -2] += user_lfs.dtype.type(global_mean)
+    return user_lfs, item_lfs, curve
+
+
+def calc_sgd_model(feedback: FeedbackMatrix, *, max_epoch_count=1000, latent_feature_count=75, alpha=0.01,
+                   gamma=0.4,
+                   accepted_deviation=2.5, solver="minibatch", batch_size=1024, biased=False, dtype=np.float64,
+                   seed=None, workers=1, **stopping_options) -> FactorModel:
+    """Factorises the feedback matrix by using matrix factorisation and stochastic gradient descent
+
+    :param feedback: FeedbackMatrix the sparse user / item matrix to predict
     :param max_epoch_count : int > 0 max number of times to iterate gradient descent to improve prediction accuracy
     :param latent_feature_count : int Number of latent factors to discover - rank to reduce data matrix to.
         The lower this is the faster to execute
@@ -52,47 +354,100 @@ def calc_sgd_predictions(feedback_df: pd.DataFrame, *, max_epoch_count=1000, lat
     :param accepted_deviation:
         the point at which the approximation is 'good enough'. Lower this is the better,
         but the longer it will take.
-    :return populated pivoted dataframe of user id against anime id with predicted ratings as values.
+    :param solver: str which training engine to use, see calc_latent_factors.
+        'svd' skips training altogether and takes a truncated SVD instead, see calc_svd_model.
+        Of the other parameters, only latent_feature_count, dtype and seed apply to it
+    :param batch_size: int number of ratings per update for the 'minibatch' solver
+    :param biased: bool whether to learn the mean rating and user / item biases too, see calc_latent_factors
+    :param dtype: the float type of the factors, e.g. np.float32 to halve their memory
+    :param seed: int seed for reproducible factors, None to use the global numpy random state
+    :param workers: int number of processes to train on, see calc_latent_factors
+    :param stopping_options: validation_fraction, patience, min_improvement and error_sample_size,
+        see calc_latent_factors
+    :return FactorModel of the user and item factors, from which any user's predicted ratings can be calculated.
+        Its training_curve is the error after every epoch
     """
 
-    if max_epoch_count <= 0:
-        max_epoch_count = 1000
+    if solver == "svd":
+        return calc_svd_model(feedback, latent_feature_count=latent_feature_count, dtype=dtype, seed=seed)
+
+    # the feedback matrix already only holds the user - item pairs of ratings that have actually been left
+    user_lfs, item_lfs, curve = calc_latent_factors(feedback.user_index, feedback.item_index, feedback.ratings,
+                                                    feedback.shape,
+                                                    max_epoch_count=max_epoch_count,
+                                                    latent_feature_count=latent_feature_count, alpha=alpha,
+                                                    gamma=gamma, accepted_deviation=accepted_deviation, solver=solver,
+                                                    batch_size=batch_size, biased=biased, dtype=dtype, seed=seed,
+                                                    workers=workers, **stopping_options)
+    global_mean = float(feedback.ratings.mean()) if biased else None
+    model = FactorModel(feedback.user_ids, feedback.item_ids, user_lfs, item_lfs, global_mean=global_mean)
+    model.training_curve = curve
+    return model
 
-    # work with numpy arrays instead of dfs
-    # demean data to help mitigate any user bias
-    feedback_matrix = feedback_df.fillna(0.0).to_numpy()
 
-    m, n = feedback_matrix.shape
-    user_lfs = np.random.rand(latent_feature_count, m)
-    item_lfs = np.random.rand(latent_feature_count, n)
+def calc_baseline_biases(users, items, ratings, shape, regularization):
+    """
+    Finds the mean rating, and how far above or below it each user and item's ratings tend to be.
+    Each bias is a damped mean: with regularization extra ratings of no difference counted in,
+    so a user or item with only a few ratings gets a bias close to 0
+    Returns
+    ---------
+    tuple of (global mean, user biases, item biases), the biases indexed by user / item position
+    """
+    m, n = shape
+    global_mean = ratings.mean(dtype=np.float64)
+    residuals = ratings - global_mean
+    item_biases = np.bincount(items, residuals, minlength=n) / (np.bincount(items, minlength=n) + regularization)
+    residuals = residuals - item_biases[items]
+    user_biases = np.bincount(users, residuals, minlength=m) / (np.bincount(users, minlength=m) + regularization)
+    return global_mean, user_biases, item_biases
+
+
+def calc_svd_model(feedback: FeedbackMatrix, *, latent_feature_count=75, bias_regularization=5.0,
+                   dtype=np.float64, seed=None) -> FactorModel:
+    """Factorises the feedback matrix with a truncated SVD, rather than training the factors
 
-    # the user - rating pairs of ratings that have actually been left
-    user, items = feedback_matrix.nonzero()
+    Ratings are mean centred first, by subtracting the mean rating and each user and item's bias from them.
+    Only the ratings that have been left are centred, which is the same as filling in every missing rating with
+    the user and item's baseline and centring the full matrix, but keeps the matrix exactly as sparse as the ratings.
+    The top latent_feature_count singular vectors of what's left are then found with truncated_svd,
+    which never builds anything dense bigger than the factors themselves.
 
-    predictions = []
+    :param feedback: FeedbackMatrix the sparse user / item matrix to predict
+    :param latent_feature_count: int number of singular values to keep
+    :param bias_regularization: float how strongly biases of users / items with few ratings are pulled towards 0,
+        see calc_baseline_biases
+    :param dtype: the float type of the factors
+    :param seed: int seed for the SVD's starting vector, None to pick one randomly
+    :return biased FactorModel, the biases in the extra columns as described there
+    """
+    users, items, ratings = feedback.user_index, feedback.item_index, feedback.ratings
+    global_mean, user_biases, item_biases = calc_baseline_biases(users, items, ratings, feedback.shape,
+                                                                 bias_regularization)
+    residuals = ratings - global_mean - user_biases[users] - item_biases[items]
+    # the feedback matrix is already sorted by user, so its offsets are the csr row pointers
+    centred = csr_matrix((residuals, items, feedback.user_offsets), shape=feedback.shape)
+
+    # svds can only find fewer singular values than the matrix's smaller dimension
+    k = max(min(latent_feature_count, min(feedback.shape) - 1), 1)
+    left, singular_values, right_t = truncated_svd(centred, k, seed)
 
-    for epoch in range(max_epoch_count):  # iterate gradient descent
-        if not PROD:
-            on_epoch_start(epoch)  # development logging stuff
-        predictions = user_lfs.T @ item_lfs  # make an approximation
-        # check how good the approximation is
-        mse = calc_validity_stats(predictions, feedback_matrix)
-        if not PROD:
-            print("MSE:", mse)
+    m, n = feedback.shape
+    # the singular values go on the users' side, so a new user's factors can be solved against the items' as they are
+    user_lfs = np.hstack((left * singular_values, (global_mean + user_biases)[:, np.newaxis], np.ones((m, 1))))
+    item_lfs = np.hstack((right_t.T, np.ones((n, 1)), item_biases[:, np.newaxis]))
+    return FactorModel(feedback.user_ids, feedback.item_ids, user_lfs.astype(dtype), item_lfs.astype(dtype),
+                       global_mean=float(global_mean))
 
-        # check if the approximation is 'good enough'
-        if mse < accepted_deviation:
-            print(f"broke after {epoch + 1} epochs")
-            break
 
-        # if not, iterate gradient descent again and improve our approximation
-        for u, i in zip(user, items):
-            dot = np.dot(user_lfs[:, u].T, item_lfs[:, i])
-            difference = feedback_matrix[u, i] - dot
-            user_lfs[:, u] += 2 * alpha * (difference * item_lfs[:, i] - gamma * user_lfs[:, u])
-            item_lfs[:, i] += 2 * alpha * (difference * user_lfs[:, u] - gamma * item_lfs[:, i])
+def calc_sgd_predictions(feedback: FeedbackMatrix, **kwargs) -> np.ndarray:
+    """Calculates the full prediction matrix using calc_sgd_model, taking the same keyword arguments.
+    This is users x items in size, so is only practical for small feedback matrices.
 
-    return predictions
+    :return populated user x item matrix of predicted ratings, ordered as feedback.user_ids and feedback.item_ids
+    """
+    model = calc_sgd_model(feedback, **kwargs)
+    return model.user_factors @ model.item_factors.T
 
 
 def calculate_similarity_score(user_embedding, show_embedding, genre_frequencies) -> int:
@@ -124,9 +479,7 @@ def calculate_similarity_score(user_embedding, show_embedding, genre_frequencies
 
 def calculate_term_frequencies(items: pd.DataFrame, field: str) -> dict:
     # vectorized approach to iterating over HUGE array.
-    terms_non_distinct = functools.reduce(operator.concat, items[field].apply(lambda row: row.split(', ')))
-    terms_distinct = set(terms_non_distinct)
-    return {term: terms_non_distinct.count(term) for term in terms_distinct}
+    return items[field].str.split(', ').explode().value_counts().to_dict()
 
 
 def calculate_item_embeddings(items: pd.DataFrame) -> dict:
@@ -149,3 +502,47 @@ def calculate_item_embeddings(items: pd.DataFrame) -> dict:
             else:  # fairly sure this never gets entered, but just in case ;)
                 embeddings[show[show_tuple_anime_id_index]][genre] += 1
     return embeddings
+
+
+def calculate_genre_matrix(items: pd.DataFrame, genres: list) -> csr_matrix:
+    """Builds the sparse items x genres matrix counting how many times each genre is listed on each item.
+    Rows are in the same order as items, columns in the same order as genres.
+    """
+    genre_lists = items["genre"].str.split(", ")
+    rows = np.repeat(np.arange(len(items)), genre_lists.str.len().to_numpy())
+    columns = pd.Categorical(genre_lists.explode(), categories=genres).codes
+    genre_matrix = csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(items), len(genres)))
+    genre_matrix.sum_duplicates()
+    return genre_matrix
+
+
+def calculate_item_embedding_matrix(genre_matrix: csr_matrix, genre_frequencies: np.ndarray) -> csr_matrix:
+    """Calculates ALL item embeddings at once as the rows of a sparse matrix.
+    Each genre count is weighted the same way calculate_similarity_score weights them,
+    so that embedding matrix @ user embedding / number of genres in user embedding
+    gives calculate_similarity_score for every item in one go.
+
+    Keyword arguments:
+    genre_matrix -- items x genres matrix from calculate_genre_matrix
+    genre_frequencies -- number of items listing each genre, in the genre_matrix's column order
+    """
+    embeddings = genre_matrix.astype(np.float64)
+    genres_per_item = np.diff(embeddings.indptr)
+    # the 1 / (0.1 * frequency) normalisation, and the penalty applied per show by its genre count
+    embeddings.data *= np.repeat(genres_per_item, genres_per_item) / (0.1 * genre_frequencies[embeddings.indices])
+    return embeddings
+
+
+def calculate_user_embedding_vector(genre_matrix: csr_matrix, item_positions, ratings,
+                                    genre_frequencies: np.ndarray) -> np.ndarray:
+    """Calculates a user's embedding from their ratings as one sparse matrix-vector product:
+    the sum of the user's ratings for each genre, normalised by how common that genre is.
+
+    Keyword arguments:
+    genre_matrix -- items x genres matrix from calculate_genre_matrix
+    item_positions -- the genre_matrix rows of the items the user rated
+    ratings -- the user's rating of each of those items
+    genre_frequencies -- number of items listing each genre, in the genre_matrix's column order
+    Return: dense vector with one score per genre, 0 for genres the user has never watched
+    """
+    return (genre_matrix[item_positions].T @ ratings) / (0.5 * genre_frequencies)
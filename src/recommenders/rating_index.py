@@ -0,0 +1,129 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+class RatingIndex:
+    """
+    Every user's ratings, grouped by user so that looking one user up costs only as much as they have ratings,
+    rather than a scan of the whole feedback DataFrame.
+    Ratings are sorted by user once, into anime_ids / ratings arrays with a CSR style offsets array:
+    the user at position p has their ratings at offsets[p]:offsets[p + 1].
+
+    Users whose ratings change afterwards are kept in a small overrides dictionary on top of the sorted arrays,
+    so an update never has to rebuild the index. They're only sorted in with everyone else by compact,
+    which a retrain calls as it reads every rating anyway.
+    One index is shared by all the recommenders in an app and the recommender route.
+    """
+
+    def __init__(self, ratings: pd.DataFrame):
+        """
+        @param ratings: feedback DataFrame with user_id, anime_id and rating columns
+        """
+        # (user ids, offsets, anime ids, ratings, user id: position) of the sorted ratings, replaced only as a whole,
+        # so a lookup always sees one consistent set of arrays
+        self.__sorted: tuple = self.__sort_ratings(ratings)
+        # user id: (anime ids, ratings) of users whose ratings have changed since the sorted arrays were built
+        self.__overrides: dict = {}
+        # held while overrides are removed, so one set at the same time is never lost
+        self.__overrides_lock = threading.Lock()
+        # held throughout compact, so two can't run at once
+        self.__compact_lock = threading.Lock()
+
+    @staticmethod
+    def __sort_ratings(ratings: pd.DataFrame) -> tuple:
+        user_ids = ratings["user_id"].to_numpy()
+        order = np.argsort(user_ids, kind="stable")
+        user_ids, counts = np.unique(user_ids[order], return_counts=True)
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        user_positions = {user_id: position for position, user_id in enumerate(user_ids.tolist())}
+        return (user_ids, offsets, ratings["anime_id"].to_numpy()[order], ratings["rating"].to_numpy()[order],
+                user_positions)
+
+    @property
+    def user_ids(self) -> np.ndarray:
+        """ids of the users in the sorted arrays, i.e. everyone who had ratings when the index was last built"""
+        return self.__sorted[0]
+
+    def __contains__(self, user_id):
+        """whether the user has any ratings"""
+        return len(self.get_user_ratings(user_id)[0]) > 0
+
+    def most_active_users(self, n: int) -> np.ndarray:
+        """ids of the n users with the most ratings when the index was last built, most first"""
+        user_ids, offsets = self.__sorted[:2]
+        rating_counts = np.diff(offsets)
+        n = min(n, len(rating_counts))
+        most = np.argpartition(-rating_counts, n - 1)[:n] if n else np.empty(0, dtype=np.int64)
+        return user_ids[most[np.argsort(-rating_counts[most], kind="stable")]]
+
+    def get_user_ratings(self, user_id) -> tuple:
+        """
+        Returns: tuple of (anime ids, ratings) arrays of the user's ratings, both empty if they haven't left any
+        """
+        # the overrides are read before the sorted arrays, as compact only removes an override once the
+        # user's ratings are in the sorted arrays that replaced the old ones
+        user_ratings = self.__overrides.get(user_id)
+        if user_ratings is not None:
+            return user_ratings
+        _, offsets, anime_ids, ratings, user_positions = self.__sorted
+        position = user_positions.get(user_id)
+        if position is None:
+            return anime_ids[:0], ratings[:0]
+        start, end = offsets[position], offsets[position + 1]
+        return anime_ids[start:end], ratings[start:end]
+
+    def set_user_ratings(self, user_id, user_ratings: pd.DataFrame):
+        """
+        Replaces a user's ratings
+        @param user_ratings: all of that user's ratings, as they are now
+        """
+        _, _, anime_ids, ratings, _ = self.__sorted
+        # a single dictionary assignment, so a request reading this user at the same time sees either
+        # all their old ratings or all their new ones
+        with self.__overrides_lock:
+            self.__overrides[user_id] = (user_ratings["anime_id"].to_numpy(dtype=anime_ids.dtype),
+                                         user_ratings["rating"].to_numpy(dtype=ratings.dtype))
+
+    def merged_ratings(self) -> pd.DataFrame:
+        """
+        Every user's ratings as they are now, overrides included, as a feedback DataFrame of user_id, anime_id and
+        rating columns. This costs as much as there are ratings, so it's only for rebuilding everything, e.g. retraining
+        """
+        # a copy, so users updated while this is being built are either all in it or not at all.
+        # Taken before the sorted arrays are read, for the same reason as in get_user_ratings
+        overrides = dict(self.__overrides)
+        return self.__merge(self.__sorted, overrides)
+
+    def compact(self) -> pd.DataFrame:
+        """
+        merged_ratings, which the sorted arrays are then rebuilt from, so the overrides it took in can be dropped
+        rather than kept forever. Users updated while this runs keep their overrides.
+        Costs a sort of every rating on top of merged_ratings, so it's only for when those are needed anyway
+        Returns: the merged ratings
+        """
+        with self.__compact_lock:
+            # a copy, so users updated while this is being built are either all in it or not at all
+            overrides = dict(self.__overrides)
+            merged = self.__merge(self.__sorted, overrides)
+            self.__sorted = self.__sort_ratings(merged)
+            with self.__overrides_lock:
+                for user_id, user_ratings in overrides.items():
+                    # anyone given newer ratings since the copy was taken still needs their override
+                    if self.__overrides.get(user_id) is user_ratings:
+                        del self.__overrides[user_id]
+        return merged
+
+    @staticmethod
+    def __merge(sorted_ratings: tuple, overrides: dict) -> pd.DataFrame:
+        user_ids, offsets, anime_ids, ratings, _ = sorted_ratings
+        rating_user_ids = np.repeat(user_ids, np.diff(offsets))
+        kept = ~np.isin(rating_user_ids, np.fromiter(overrides, dtype=user_ids.dtype, count=len(overrides)))
+        user_id_parts, anime_id_parts, rating_parts = [rating_user_ids[kept]], [anime_ids[kept]], [ratings[kept]]
+        for user_id, (user_anime_ids, user_ratings) in overrides.items():
+            user_id_parts.append(np.full(len(user_anime_ids), user_id, dtype=user_ids.dtype))
+            anime_id_parts.append(user_anime_ids)
+            rating_parts.append(user_ratings)
+        return pd.DataFrame({"user_id": np.concatenate(user_id_parts), "anime_id": np.concatenate(anime_id_parts),
+                             "rating": np.concatenate(rating_parts)})
@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+
+
+class RecommendationCache:
+    """
+    Least recently used cache of users' top recommendations.
+    Each entry is one user's best top_k recommendations from one recommender, as a column name: small array
+    dictionary of what the recommender's generate_recommendations gives, so any request for top_k or fewer
+    recommendations is just a slice of them.
+    Holds at most max_entries entries, dropping the least recently used once full.
+    """
+
+    def __init__(self, top_k: int, max_entries: int):
+        self.top_k = top_k
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # (recommender name, user id): {column name: values}
+        self.__entries = OrderedDict()
+        # every recommender name an entry has been stored under, so a user's entries can be found without a scan
+        self.__recommender_names = set()
+        self.__lock = threading.Lock()
+        # goes up whenever the whole cache is cleared, so results worked out before that are never stored after it
+        self.__generation = 0
+        # user id: goes up whenever that user's entries are invalidated, which only holds back their own results
+        self.__user_versions = {}
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def version(self, user_id) -> tuple:
+        """pass this to put, read before working out the user's recommendations to be stored"""
+        with self.__lock:
+            return self.__generation, self.__user_versions.get(user_id, 0)
+
+    def get(self, recommender_name: str, user_id, recommendation_count: int):
+        """
+        Returns: the user's column name: array dictionary, best first, cut down to recommendation_count,
+        or None if they aren't cached
+        """
+        key = (recommender_name, user_id)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+        return {column: values[:recommendation_count] for column, values in entry.items()}
+
+    def put(self, recommender_name: str, user_id, recommendations: dict, version: tuple):
+        """
+        Stores a user's top_k recommendations, unless the cache has been cleared or the user invalidated since
+        version was read, in which case they may already be out of date
+        """
+        with self.__lock:
+            if version != (self.__generation, self.__user_versions.get(user_id, 0)):
+                return
+            key = (recommender_name, user_id)
+            self.__recommender_names.add(recommender_name)
+            self.__entries[key] = recommendations
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        """Forgets all of a user's recommendations, from every recommender"""
+        with self.__lock:
+            self.__user_versions[user_id] = self.__user_versions.get(user_id, 0) + 1
+            for recommender_name in self.__recommender_names:
+                self.__entries.pop((recommender_name, user_id), None)
+
+    def clear(self):
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.clear()
+            # the new generation already rules out every version read before now
+            self.__user_versions.clear()
+
+    def metrics(self) -> dict:
+        return {"entries": len(self.__entries), "max_entries": self.max_entries, "top_k": self.top_k,
+                "hits": self.hits, "misses": self.misses}
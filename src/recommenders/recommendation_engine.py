@@ -1,17 +1,23 @@
 import logging
 from typing import Dict
 
+import numpy as np
+import pandas as pd
+
 from src.exceptions import DimensionError, DataMatchError, DuplicateKeyError
+from src.recommenders.dataset import Dataset
+from src.recommenders.hybrid_recommender import HybridRecommender
+from src.recommenders.recommendation_cache import RecommendationCache
 from src.recommenders.recommender import Recommender
 
 
 class RecommendationEngine:
 
-    def __init__(self, items, feedback, recommenders: Dict[str, Recommender]):
+    def __init__(self, dataset: Dataset, recommenders: Dict[str, Recommender], cache: RecommendationCache = None):
         """
-        @param items: the items all the recommenders are trained on
-        @param feedback: the feedback all the recommenders are trained on
+        @param dataset: the items and feedback all the recommenders are trained on
         @param recommenders: a name: instance dictionary of all the recommenders to aggregate
+        @param cache: if given, users' top recommendations are kept in it between requests by get_recommendations
         """
         # otherwise, what's the point
         if len(recommenders) <= 1:
@@ -19,19 +25,110 @@ class RecommendationEngine:
 
         # make sure all recommenders are trained on the same dataset
         for recommender in recommenders.values():
-            if not (recommender.shows.equals(items) and recommender.ratings.equals(feedback)):
+            if not dataset.is_compatible(recommender.dataset):
                 raise DataMatchError("All recommenders must be trained on the passed "
                                      "items / feedback dataset to "
                                      "be used in conjunction")
         self.recommenders = recommenders
+        # what update_user_ratings updates. A hybrid's update_user just passes the user on to its recommenders,
+        # which are usually in the engine too, so hybrids are swapped for their recommenders
+        # to have each recommender update a user only once
+        self.__recommenders_to_update = self.__distinct_recommenders(recommenders.values())
+
+        self.cache = cache
+        if cache is not None:
+            # results stay the same until either a user's ratings change or a model is retrained,
+            # so a new model means nothing cached can be trusted any more
+            for recommender in recommenders.values():
+                recommender.model_swap_listeners.append(cache.clear)
 
-    def refresh_recommenders(self, updated_ratings):
+    def update_user_ratings(self, user_id, user_ratings):
         """
-        refreshes all recommenders to align with newly inserted ratings
+        updates all recommenders for one user's changed ratings, without retraining them from scratch.
+        The new ratings only go into the rating index, the dataset stays as it is
+        @param user_id: the user whose ratings changed
+        @param user_ratings: all of that user's ratings, as they are now
         """
         for recommender in self.recommenders.values():
-            recommender.ratings = updated_ratings
-            recommender.refresh()
+            # recommenders usually share one index, setting a user's ratings on it again is harmless
+            recommender.rating_index.set_user_ratings(user_id, user_ratings)
+        for recommender in self.__recommenders_to_update:
+            recommender.update_user(user_id, user_ratings)
+        if self.cache is not None:
+            self.cache.invalidate_user(user_id)
+
+    @staticmethod
+    def __distinct_recommenders(recommenders) -> list:
+        """recommenders, with each hybrid replaced by the recommenders it's made of, and none of them twice"""
+        distinct = []
+        for recommender in recommenders:
+            if isinstance(recommender, HybridRecommender):
+                parts = RecommendationEngine.__distinct_recommenders(part for part, _ in recommender.recommenders)
+            else:
+                parts = [recommender]
+            distinct.extend(part for part in parts if not any(part is seen for seen in distinct))
+        return distinct
+
+    def get_recommendations(self, recommender_name, user_id, recommendation_count: int = 10,
+                            verbose: bool = False) -> pd.DataFrame:
+        """
+        A user's top recommendations from one of the recommenders, never including shows they've already rated.
+        Served from the cache whenever recommendation_count is within its top_k
+        Returns: the recommender's generate_recommendations DataFrame, the same whether it was cached or not
+        """
+        recommender = self.recommenders[recommender_name]
+        if self.cache is None or not 0 <= recommendation_count <= self.cache.top_k:
+            items_to_ignore, _ = recommender.rating_index.get_user_ratings(user_id)
+            return recommender.generate_recommendations(user_id, recommendation_count, verbose, items_to_ignore)
+
+        cached = self.cache.get(recommender_name, user_id, recommendation_count)
+        if cached is None:
+            # the version is read before the user's ratings, so if they change in between the version is already
+            # out of date and put turns these recommendations away, rather than caching ones from the old ratings
+            version = self.cache.version(user_id)
+            items_to_ignore, _ = recommender.rating_index.get_user_ratings(user_id)
+            # a single user is scored just as an uncached request would be, so a hybrid still runs its
+            # recommenders at the same time on its executor, and gives up on any that are too slow
+            top_shows = recommender.generate_recommendations(user_id, self.cache.top_k, False, items_to_ignore)
+            cached = {column: top_shows[column].to_numpy() for column in top_shows.columns}
+            # recommendations missing a recommender that failed or timed out are only good for this request
+            if not top_shows.attrs.get("degraded", False):
+                self.cache.put(recommender_name, user_id, cached, version)
+            cached = {column: values[:recommendation_count] for column, values in cached.items()}
+
+        top_shows = pd.DataFrame(cached)
+        if verbose:  # add all other show data if requested
+            top_shows = top_shows.merge(recommender.shows, how="left", left_on="anime_id", right_on="anime_id")
+        return top_shows
+
+    def warm_cache(self, user_ids, recommender_names=None, batch_size: int = 1024):
+        """
+        Fills the cache with the top recommendations of user_ids ahead of them being asked for,
+        batch_size users at a time
+        @param recommender_names: the recommenders to fill it from, all of them by default
+        """
+        if self.cache is None:
+            return
+        user_ids = np.asarray(user_ids)
+        for recommender_name in recommender_names or self.recommenders:
+            recommender = self.recommenders[recommender_name]
+            for start in range(0, len(user_ids), batch_size):
+                batch = user_ids[start:start + batch_size]
+                versions = [self.cache.version(user_id) for user_id in batch.tolist()]
+                frames = recommender.generate_recommendation_frames(batch, self.cache.top_k, batch_size=batch_size)
+                for user_id, version, top_shows in zip(batch.tolist(), versions, frames):
+                    self.cache.put(recommender_name, user_id,
+                                   {column: top_shows[column].to_numpy() for column in top_shows.columns}, version)
+
+    def generate_recommendations_batch(self, recommender_name, user_ids, recommendation_count: int = 10,
+                                       exclude_rated: bool = True) -> tuple:
+        """
+        top recommendations of many users at once from one of the recommenders, see
+        Recommender.generate_recommendations_batch
+        Returns: tuple of (ids, scores), both len(user_ids) x recommendation_count arrays
+        """
+        return self.recommenders[recommender_name].generate_recommendations_batch(user_ids, recommendation_count,
+                                                                                  exclude_rated)
 
     def get_recommender(self, recommender_name):
         try:
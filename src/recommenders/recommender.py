@@ -1,16 +1,40 @@
 from abc import ABC, abstractmethod
 
+import numpy as np
 import pandas as pd
 
+from src.recommenders.dataset import Dataset
+from src.recommenders.rating_index import RatingIndex
+from src.utils import top_n_indices_2d
+
 
 class Recommender(ABC):
 
-    def __init__(self, shows: pd.DataFrame, ratings: pd.DataFrame):
-        self.shows: pd.DataFrame = shows
-        self.ratings: pd.DataFrame = ratings
+    def __init__(self, dataset: Dataset, rating_index: RatingIndex = None):
+        """
+        dataset -- the shows and ratings to recommend from. Shared, not copied, so give every recommender the same one\n
+        rating_index -- per user index of ratings. Pass the same one to every recommender built on these ratings
+        so they share it, otherwise each builds its own\n
+        """
+        self.dataset: Dataset = dataset
+        self.rating_index: RatingIndex = RatingIndex(dataset.ratings) if rating_index is None else rating_index
+        # every recommender scores shows in this same fixed order, the dataset's, so recommenders built on the same
+        # shows can combine their scores as plain arrays
+        self.item_ids: np.ndarray = dataset.item_ids
+        self.item_positions: dict = dataset.item_positions
+        # functions to call, with no arguments, whenever a newly trained model is swapped in for the old one
+        self.model_swap_listeners: list = []
         self.show_embeddings: dict = {}
         self.user_embeddings: dict = {}
 
+    @property
+    def shows(self) -> pd.DataFrame:
+        return self.dataset.items
+
+    @property
+    def ratings(self) -> pd.DataFrame:
+        return self.dataset.ratings
+
     @abstractmethod
     def generate_recommendations(self, user_id: int, recommendation_count: int = 10, verbose: bool = False,
                                  items_to_ignore=None) -> pd.DataFrame:
@@ -27,6 +51,112 @@ class Recommender(ABC):
         """
         pass
 
+    def score_items(self, user_id: int) -> np.ndarray:
+        """
+        Raw recommendation score of every item for a user, aligned with self.item_ids.
+        Items this recommender has no score for are NaN.
+        Recommenders that can score every item in one go should override this, by default it's built from
+        generate_recommendations.
+
+        Parameters
+        ----------
+        user_id -- the id of the user whose scores you want\n
+        """
+        recs = self.generate_recommendations(user_id, -1, False, [])
+        scores = np.full(len(self.item_ids), np.nan)
+        positions = [self.item_positions.get(item_id, -1) for item_id in recs["anime_id"]]
+        positions = np.array(positions, dtype=np.int64)
+        known = positions != -1
+        scores[positions[known]] = recs[self.get_score_column_name()].to_numpy(dtype=np.float64)[known]
+        return scores
+
+    def score_items_batch(self, user_ids) -> np.ndarray:
+        """
+        score_items for many users at once. Recommenders that can score several users as one matrix product
+        should override this, by default it's score_items one user at a time.
+
+        Parameters
+        ----------
+        user_ids -- the ids of the users whose scores you want\n
+        Returns
+        -------
+        len(user_ids) x len(self.item_ids) array of scores, NaN for items with no score
+        """
+        return np.array([self.score_items(user_id) for user_id in user_ids]).reshape(len(user_ids), -1)
+
+    def generate_recommendations_batch(self, user_ids, recommendation_count: int = 10, exclude_rated: bool = True,
+                                       batch_size: int = 1024) -> tuple:
+        """
+        Finds the top recommendations for many users at once.
+        Users are scored batch_size at a time with score_items_batch, so memory stays at batch_size x items
+
+        Parameters
+        ----------
+        user_ids -- the ids of the users you want recommendations for\n
+        recommendation_count -- the number of recommendations per user. -1 gives every item\n
+        exclude_rated -- if True, items a user has already rated are never recommended to them\n
+        batch_size -- how many users to score in one go\n
+        Returns
+        -------
+        tuple of (ids, scores), both len(user_ids) x recommendation_count arrays, each row best first.
+        Rows of users with fewer recommendations than that are padded with -1 ids and NaN scores,
+        and users with no ratings get nothing but padding
+        """
+        user_ids = np.asarray(user_ids)
+        if not 0 <= recommendation_count <= len(self.item_ids):
+            recommendation_count = len(self.item_ids)
+        top_ids = np.full((len(user_ids), recommendation_count), -1, dtype=self.item_ids.dtype)
+        top_scores = np.full((len(user_ids), recommendation_count), np.nan)
+
+        # users with no ratings have nothing to go on, whatever each recommender would make up for them,
+        # so they're left as padding rather than scored
+        rows = np.flatnonzero(self.known_users(user_ids))
+        for start in range(0, len(rows), batch_size):
+            batch_rows = rows[start:start + batch_size]
+            batch = user_ids[batch_rows]
+            scores = self.score_items_batch(batch)
+            # items without a score, and already rated ones, can't be picked
+            scores[np.isnan(scores)] = -np.inf
+            if exclude_rated:
+                for row, user_id in enumerate(batch.tolist()):
+                    rated_ids, _ = self.rating_index.get_user_ratings(user_id)
+                    scores[row, [self.item_positions[item_id] for item_id in rated_ids.tolist()
+                                 if item_id in self.item_positions]] = -np.inf
+
+            best = top_n_indices_2d(scores, recommendation_count)
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            found = best_scores != -np.inf
+            top_ids[batch_rows] = np.where(found, self.item_ids[best], -1)
+            top_scores[batch_rows] = np.where(found, best_scores, np.nan)
+        return top_ids, top_scores
+
+    def known_users(self, user_ids) -> np.ndarray:
+        """
+        Boolean mask of which of user_ids have left any ratings, and so can be recommended for
+        """
+        return np.fromiter((user_id in self.rating_index for user_id in user_ids), dtype=bool, count=len(user_ids))
+
+    def generate_recommendation_frames(self, user_ids, recommendation_count: int = 10, exclude_rated: bool = True,
+                                       batch_size: int = 1024) -> list:
+        """
+        generate_recommendations_batch, as the same DataFrame generate_recommendations gives (not verbose) for each
+        user, so results worked out in bulk can stand in for single requests.
+        Recommenders whose generate_recommendations gives more than anime_id and the score column should override
+        this to match.
+
+        Parameters
+        ----------
+        as for generate_recommendations_batch\n
+        Returns
+        -------
+        list of DataFrames, one per user in user_ids
+        """
+        top_ids, top_scores = self.generate_recommendations_batch(user_ids, recommendation_count, exclude_rated,
+                                                                  batch_size)
+        score_column = self.get_score_column_name()
+        return [pd.DataFrame({"anime_id": ids[ids != -1], score_column: scores[ids != -1]})
+                for ids, scores in zip(top_ids, top_scores)]
+
     @abstractmethod
     def refresh(self):
         """
@@ -34,6 +164,20 @@ class Recommender(ABC):
         """
         pass
 
+    def update_user(self, user_id: int, user_ratings: pd.DataFrame):
+        """
+        Brings the recommender up to date with one user's new set of ratings, to be called after
+        self.rating_index has been updated with them.
+        Recommenders that can update a single user cheaply should override this, by default it falls back to
+        a full refresh.
+
+        Parameters
+        ----------
+        user_id -- the id of the user whose ratings changed\n
+        user_ratings -- all of that user's ratings, as they are now\n
+        """
+        self.refresh()
+
     @abstractmethod
     def get_score_column_name(self) -> str:
         """
@@ -0,0 +1,94 @@
+import logging
+import threading
+import time
+
+from src.recommenders.collaborative_recommender import CollabRecommender
+
+
+class TrainingScheduler:
+    """
+    Retrains a CollabRecommender on a background thread, so no request ever has to wait for training.
+    A retrain happens every interval seconds, or sooner once rating_threshold new ratings have come in.
+    The recommender swaps the new model in itself once it is complete, see CollabRecommender.retrain.
+    """
+
+    def __init__(self, recommender: CollabRecommender, interval: float, rating_threshold: int):
+        """
+        @param recommender: the recommender to keep retraining
+        @param interval: most seconds to go between retrains
+        @param rating_threshold: number of new ratings that triggers a retrain before interval is up
+        """
+        self.recommender = recommender
+        self.interval = interval
+        self.rating_threshold = rating_threshold
+
+        self.new_rating_count = 0
+        self.training_count = 0
+        self.training_in_progress = False
+        self.last_error = None
+
+        self.__wake = threading.Event()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is None or not self.__thread.is_alive():
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__run, name="collab-training", daemon=True)
+            self.__thread.start()
+
+    def stop(self, timeout=None):
+        self.__stop.set()
+        self.__wake.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+
+    def notify_new_ratings(self, count: int = 1):
+        """
+        Records that ratings have been added or changed, waking the worker up early if there are enough of them
+        """
+        self.new_rating_count += count
+        if self.new_rating_count >= self.rating_threshold:
+            self.__wake.set()
+
+    def request_retrain(self):
+        """Asks for a retrain as soon as the worker is free, without waiting for it"""
+        self.__wake.set()
+
+    def __run(self):
+        while not self.__stop.is_set():
+            self.__wake.wait(self.interval)
+            self.__wake.clear()
+            if self.__stop.is_set():
+                break
+            self.retrain()
+
+    def retrain(self):
+        """Retrains the recommender right now, on the calling thread"""
+        self.training_in_progress = True
+        # ratings arriving from here on might not make it into this model, so count them towards the next one
+        self.new_rating_count = 0
+        try:
+            model = self.recommender.retrain()
+        except Exception as error:  # keep serving the old model, and try again next time
+            logging.exception("Retraining collaborative model failed")
+            self.last_error = repr(error)
+        else:
+            self.training_count += 1
+            self.last_error = None
+            logging.info(f"Collaborative model retrained in {model.training_seconds:.1f}s")
+        finally:
+            self.training_in_progress = False
+
+    def metrics(self) -> dict:
+        model = self.recommender.model
+        return {
+            "model_age_seconds": None if model.trained_at is None else time.time() - model.trained_at,
+            "model_trained_at": model.trained_at,
+            "last_training_seconds": model.training_seconds,
+            "last_training_epochs": None if model.training_curve is None else len(model.training_curve),
+            "training_in_progress": self.training_in_progress,
+            "trainings_completed": self.training_count,
+            "new_ratings_since_training": self.new_rating_count,
+            "last_error": self.last_error,
+        }
@@ -1,9 +1,9 @@
-import logging
 import numpy as np
 from flask import request
 from pandas.core.frame import DataFrame
 from pandas.core.series import Series
-from scipy.sparse.linalg.eigen.arpack.arpack import svds
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import svds
 import requests
 from sklearn.metrics import mean_squared_error
 
@@ -80,8 +80,13 @@ def add_anime_info(anime_df: DataFrame, db):
 
 
 def find_svd(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    """finds the singular value decomposition of a matrix
-    
+    """finds the singular value decomposition of a matrix, largest singular value first
+
+    The matrix is decomposed directly, rather than by eigen-decomposing matrix.T @ matrix and matrix @ matrix.T.
+    Those are square in each of matrix's dimensions, so far bigger than matrix itself, and decomposing them
+    separately doesn't pair each left singular vector up with its right one.
+    For a large or sparse matrix of which only the top singular vectors are needed, use truncated_svd.
+
     Parameters
     ----------
     matrix:
@@ -89,23 +94,38 @@ def find_svd(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     Returns
     -------
     U:
-        Left factor of matrix as np.ndarray
-    V_T:
-        Right factor of matrix as np.ndarray
+        Left factor of matrix as np.ndarray, one column per singular value
     S:
-        1D array of singular values of matrix
+        1D array of singular values of matrix, in descending order
+    V_T:
+        Right factor of matrix as np.ndarray, one row per singular value
     """
-    left_transpose = matrix.T @ matrix
-    # calculate left singular vectors
-    eigen_values, left_singular_vectors = np.linalg.eigh(left_transpose)
-    right_transpose = matrix @ matrix.T
-    # calculate right singular vectors
-    _, right_singular_vectors = np.linalg.eigh(right_transpose)
-    # calculate singular values
-    logging.debug(eigen_values)
-    singular_values = np.sqrt(eigen_values)
+    return np.linalg.svd(matrix, full_matrices=False)
 
-    return right_singular_vectors, singular_values, left_singular_vectors.T
+
+def truncated_svd(matrix: csr_matrix, k: int, seed=None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """finds the top k singular values of a sparse matrix, and their singular vectors
+
+    Uses ARPACK through scipy's svds, which only ever multiplies matrix (and its transpose) by vectors,
+    so neither matrix itself nor either of its Gram matrices is ever made dense.
+
+    Parameters
+    ----------
+    matrix:
+        the matrix to decompose, e.g. a csr_matrix
+    k:
+        how many singular values to find, less than both of matrix's dimensions
+    seed:
+        seed for ARPACK's starting vector, so the same matrix always gives the same vectors. None picks one randomly
+    Returns
+    -------
+    U, S, V_T as for find_svd, with only the top k singular values, largest first
+    """
+    start = np.random.default_rng(seed).random(min(matrix.shape))
+    left, singular_values, right_t = svds(matrix, k=k, v0=start)
+    # svds gives them smallest first
+    order = np.argsort(-singular_values)
+    return left[:, order], singular_values[order], right_t[order]
 
 
 def rank_reduce_matrix(matrix, k):
@@ -124,19 +144,11 @@ def rank_reduce_matrix(matrix, k):
     """
     # find the singular value decomposition of the matrix
     left_singular_vectors, singular_values, right_singular_vectors_T = find_svd(matrix)
-    # find_svd returns singular values in a 1d array, 
-    singular_diagonal_matrix = np.zeros(matrix.shape)
-    # so populate the proper sized array with them.
-    np.fill_diagonal(singular_diagonal_matrix, singular_values)
 
-    # rank reduce each matrix by taking the first k rows of S and the first k singular vectors of U and V_T
-    left_rank_reduced = left_singular_vectors[:, :k]
-    singular_vals_rank_reduced = singular_diagonal_matrix[:k, :k]
-    right_T_rank_reduced = right_singular_vectors_T[:k, :]
-
-    # calculate low rank factors
-    left_factor = left_rank_reduced
-    right_factor = singular_vals_rank_reduced @ right_T_rank_reduced
+    # rank reduce by taking the first k singular values and the first k singular vectors of U and V_T.
+    # the singular values scale the rows of V_T, so they're broadcast over them rather than put in a diagonal matrix
+    left_factor = left_singular_vectors[:, :k]
+    right_factor = singular_values[:k, np.newaxis] * right_singular_vectors_T[:k, :]
 
     return left_factor, right_factor
 
@@ -147,6 +159,74 @@ def rank_reduce_matrix_scipy(matrix, k):
     return (u @ sigma).T, vt
 
 
+def exclusion_mask(positions: dict, size: int, ids_to_exclude) -> np.ndarray:
+    """Builds a boolean mask over an array of items, True at every item whose id is in ids_to_exclude
+
+    Parameters
+    ----------
+    positions:
+        id: position dictionary of the items the mask is for
+    size:
+        length of the mask
+    ids_to_exclude:
+        ids of the items to mark. Ids with no position are skipped
+    """
+    mask = np.zeros(size, dtype=bool)
+    if ids_to_exclude is not None:
+        mask[[positions[item_id] for item_id in ids_to_exclude if item_id in positions]] = True
+    return mask
+
+
+def top_n_indices(scores: np.ndarray, n: int, exclude: np.ndarray = None) -> np.ndarray:
+    """Finds the positions of the n highest scores, highest first.
+    Uses np.argpartition so only the n winners get sorted, rather than every score.
+
+    Parameters
+    ----------
+    scores:
+        1D array of scores
+    n:
+        how many positions to return. -1 (or any n past the end) returns every position
+    exclude:
+        optional boolean mask the same length as scores, positions where it is True are never returned
+    Returns
+    -------
+    1D array of positions into scores
+    """
+    candidates = np.arange(len(scores)) if exclude is None else np.flatnonzero(~exclude)
+    candidate_scores = scores[candidates]
+    if 0 <= n < len(candidates):
+        best = np.argpartition(-candidate_scores, n)[:n]
+    else:
+        best = np.arange(len(candidates))
+    # sort just the winners
+    best = best[np.argsort(-candidate_scores[best], kind="stable")]
+    return candidates[best]
+
+
+def top_n_indices_2d(scores: np.ndarray, n: int) -> np.ndarray:
+    """Finds the positions of the n highest scores in every row of a matrix, highest first.
+    The many users version of top_n_indices, done for every row at once.
+
+    Parameters
+    ----------
+    scores:
+        2D array of scores, one row per user. Set anything that mustn't be picked to -np.inf
+    n:
+        how many positions to return per row, at most the number of columns
+    Returns
+    -------
+    rows x n array of column positions into scores
+    """
+    if n < scores.shape[1]:
+        best = np.argpartition(-scores, n, axis=1)[:, :n]
+    else:
+        best = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    # sort just the winners
+    order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(best, order, axis=1)
+
+
 def calc_mean_squared_error(prediction, actual):
     prediction = prediction[actual.nonzero()].flatten()
     actual = actual[actual.nonzero()].flatten()
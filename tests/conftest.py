@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the app runs from src, and some of its modules import each other without the src. prefix
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "src")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
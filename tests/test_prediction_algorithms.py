@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from src.recommenders.prediction_algorithms import calc_latent_factors, minibatch_sgd_epoch, sgd_epoch
+
+
+def random_ratings(user_count=60, item_count=40, rating_count=1500, seed=0):
+    rng = np.random.default_rng(seed)
+    users = rng.integers(user_count, size=rating_count)
+    items = rng.integers(item_count, size=rating_count)
+    ratings = rng.integers(1, 11, size=rating_count).astype(np.float64)
+    return users, items, ratings
+
+
+def biased_factors(user_count, item_count, latent_feature_count=5, seed=0):
+    rng = np.random.default_rng(seed)
+    user_lfs = np.hstack((rng.standard_normal((user_count, latent_feature_count)),
+                          np.zeros((user_count, 1)), np.ones((user_count, 1))))
+    item_lfs = np.hstack((rng.standard_normal((item_count, latent_feature_count)),
+                          np.ones((item_count, 1)), np.zeros((item_count, 1))))
+    user_trainable = np.ones(latent_feature_count + 2)
+    user_trainable[-1] = 0
+    item_trainable = np.ones(latent_feature_count + 2)
+    item_trainable[-2] = 0
+    return user_lfs, item_lfs, user_trainable, item_trainable
+
+
+@pytest.mark.parametrize("solver", ["sgd", "minibatch"])
+def test_epoch_leaves_fixed_columns_alone(solver):
+    users, items, ratings = random_ratings()
+    user_lfs, item_lfs, user_trainable, item_trainable = biased_factors(60, 40)
+    if solver == "sgd":
+        sgd_epoch(user_lfs, item_lfs, users, items, ratings - ratings.mean(), 0.01, 0.1,
+                  user_trainable, item_trainable)
+    else:
+        minibatch_sgd_epoch(user_lfs, item_lfs, users, items, ratings - ratings.mean(), 0.01, 0.1, 64,
+                            np.random.default_rng(0), user_trainable, item_trainable)
+
+    assert np.all(user_lfs[:, -1] == 1)
+    assert np.all(item_lfs[:, -2] == 1)
+    # the bias columns themselves are still trained
+    assert np.any(user_lfs[:, -2] != 0)
+    assert np.any(item_lfs[:, -1] != 0)
+
+
+@pytest.mark.parametrize("solver, workers", [("sgd", 1), ("minibatch", 1), ("minibatch", 2)])
+def test_biased_training_keeps_constant_columns(solver, workers):
+    users, items, ratings = random_ratings()
+    user_lfs, item_lfs, _ = calc_latent_factors(users, items, ratings, (60, 40), max_epoch_count=1,
+                                                latent_feature_count=5, solver=solver, batch_size=64,
+                                                biased=True, seed=0, workers=workers)
+
+    assert np.all(user_lfs[:, -1] == 1)
+    assert np.all(item_lfs[:, -2] == 1)
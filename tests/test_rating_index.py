@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+from src.recommenders.rating_index import RatingIndex
+
+
+def feedback(user_ids, anime_ids, ratings):
+    return pd.DataFrame({"user_id": np.array(user_ids, dtype=np.int32), "anime_id": np.array(anime_ids, dtype=np.int32),
+                         "rating": np.array(ratings, dtype=np.int8)})
+
+
+def test_compact_sorts_overrides_in():
+    index = RatingIndex(feedback([3, 1, 3, 2], [10, 11, 12, 10], [5, 6, 7, 8]))
+    index.set_user_ratings(1, feedback([1, 1], [12, 13], [9, 4]))
+    index.set_user_ratings(4, feedback([4], [10], [2]))
+    index.set_user_ratings(2, feedback([], [], []))
+
+    merged = index.compact()
+
+    assert len(merged) == 5
+    np.testing.assert_array_equal(index.user_ids, [1, 3, 4])
+    np.testing.assert_array_equal(index.get_user_ratings(1)[0], [12, 13])
+    np.testing.assert_array_equal(index.get_user_ratings(3)[1], [5, 7])
+    np.testing.assert_array_equal(index.get_user_ratings(4)[1], [2])
+    assert 2 not in index
+    # nothing is left on top of the sorted arrays
+    pd.testing.assert_frame_equal(index.merged_ratings().sort_values(["user_id", "anime_id"], ignore_index=True),
+                                  merged.sort_values(["user_id", "anime_id"], ignore_index=True))
+
+
+def test_ratings_changed_after_compact_are_kept():
+    index = RatingIndex(feedback([1, 2], [10, 10], [5, 6]))
+    index.set_user_ratings(1, feedback([1], [11], [3]))
+    index.compact()
+    index.set_user_ratings(1, feedback([1], [12], [4]))
+
+    np.testing.assert_array_equal(index.get_user_ratings(1)[0], [12])
+    np.testing.assert_array_equal(index.compact().sort_values("user_id")["anime_id"], [12, 10])
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.recommenders.collaborative_recommender import CollabRecommender
+from src.recommenders.content_recommender import ContentRecommender
+from src.recommenders.dataset import Dataset
+from src.recommenders.hybrid_recommender import HybridRecommender
+
+GENRES = ["Action", "Comedy", "Drama", "Sci-Fi", "Romance", "Slice of Life"]
+
+
+@pytest.fixture(scope="module")
+def recommenders():
+    rng = np.random.default_rng(0)
+    show_count = 30
+    shows = pd.DataFrame({
+        "anime_id": np.arange(show_count, dtype=np.int32) * 5 + 1,
+        "name": [f"show {i}" for i in range(show_count)],
+        "genre": [", ".join(rng.choice(GENRES, rng.integers(1, 4), replace=False)) for _ in range(show_count)],
+    })
+    ratings = pd.DataFrame({"user_id": rng.integers(40, size=600).astype(np.int32) * 3 + 7,
+                            "anime_id": rng.choice(shows["anime_id"], 600),
+                            "rating": rng.integers(1, 11, size=600).astype(np.int8)})
+    ratings = ratings.drop_duplicates(["user_id", "anime_id"]).reset_index(drop=True)
+    dataset = Dataset(shows, ratings)
+
+    content_r = ContentRecommender(dataset)
+    collab_r = CollabRecommender(dataset, rating_index=content_r.rating_index, max_epoch_count=5, seed=0)
+    hybrid_r = HybridRecommender(dataset, [(content_r, 1.0), (collab_r, 2.0)], rating_index=content_r.rating_index)
+    return {"content": content_r, "collab": collab_r, "hybrid": hybrid_r}
+
+
+@pytest.mark.parametrize("name", ["content", "collab", "hybrid"])
+def test_batch_recommendations_pad_unknown_users(recommenders, name):
+    recommender = recommenders[name]
+    known_user, unknown_user = 7, 8  # user ids are all 7 more than a multiple of 3
+    assert known_user in recommender.rating_index and unknown_user not in recommender.rating_index
+
+    top_ids, top_scores = recommender.generate_recommendations_batch([known_user, unknown_user, known_user], 5)
+
+    assert np.all(top_ids[1] == -1) and np.all(np.isnan(top_scores[1]))
+    assert np.all(top_ids[0] != -1)
+    np.testing.assert_array_equal(top_ids[0], top_ids[2])
+
+    frames = recommender.generate_recommendation_frames([unknown_user, known_user], 5)
+    assert frames[0].empty and len(frames[1]) == 5